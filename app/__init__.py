@@ -0,0 +1,4 @@
+from dotenv import load_dotenv
+
+# Loaded before any submodule reads its settings from the environment
+load_dotenv()
@@ -0,0 +1,340 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import delete, select
+from . import database, models
+from .log import get_logger
+import asyncio
+import datetime
+import mmap
+import msgpack
+import os
+import struct
+import threading
+import zlib
+
+# Cold storage for old history. Messages older than ARCHIVE_AFTER_DAYS are moved
+# out of the messages table, in blocks of up to ARCHIVE_BLOCK_SIZE rows, into
+# one append-only segment file per space:
+#
+#   <ARCHIVE_DIR>/<space_id>.seg  zlib-compressed msgpack blocks, oldest first
+#   <ARCHIVE_DIR>/<space_id>.idx  one fixed-size _INDEX record per block
+#
+# Readers load the index and mmap the segment, so only the blocks a page
+# touches are read and decompressed. Archived rows are always older than any
+# row left in the table, which is what lets crud_async page across both by
+# simply continuing from one into the other. Archived messages are read-only:
+# deleting one is refused with 410 Gone.
+#
+# File access (index refresh, mmap, decompression) happens on worker threads:
+# callers go through MessageArchive's async methods. When archiving is off and
+# nothing was ever archived, those return straight away without touching disk.
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "0"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_BLOCK_SIZE = int(os.getenv("ARCHIVE_BLOCK_SIZE", "1000"))
+ARCHIVE_BLOCK_CACHE = int(os.getenv("ARCHIVE_BLOCK_CACHE", "64"))
+
+# first_ts, first_id, last_ts, last_id, min_id, max_id, offset, length
+_INDEX = struct.Struct("<qqqqqqQI")
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+logger = get_logger(__name__)
+
+# Guards the block cache shared by every SpaceArchive
+_cache_lock = threading.Lock()
+
+# (timestamp in microseconds, id): the order history is paged in
+Key = Tuple[int, int]
+
+
+def to_micros(timestamp: datetime.datetime) -> int:
+    return (timestamp - _EPOCH) // datetime.timedelta(microseconds=1)
+
+def from_micros(micros: int) -> datetime.datetime:
+    return _EPOCH + datetime.timedelta(microseconds=micros)
+
+
+class SpaceArchive:
+    # One space's segment and index. Rows inside a block are stored as
+    # [id, sender_id, content, ts_micros, is_deleted] in key order.
+    def __init__(self, directory: str, space_id: int, block_cache: "OrderedDict"):
+        self.space_id = space_id
+        self.segment_path = os.path.join(directory, f"{space_id}.seg")
+        self.index_path = os.path.join(directory, f"{space_id}.idx")
+        self.block_cache = block_cache
+        self.entries: List[tuple] = []
+        self.first_keys: List[Key] = []
+        self.last_keys: List[Key] = []
+        # (min_id, position) sorted, and the running max of max_id in that
+        # order, so find() only opens blocks whose id range could hold an id
+        self.by_min_id: List[Tuple[int, int]] = []
+        self.max_ids: List[int] = []
+        self.index_size = 0
+        self.segment_file = None
+        self.view: Optional[mmap.mmap] = None
+        # Blocking methods run on worker threads, possibly several at once
+        self.lock = threading.RLock()
+
+    def refresh(self):
+        # Pick up blocks appended since the last read (possibly by another process)
+        with self.lock:
+            try:
+                size = os.path.getsize(self.index_path)
+            except OSError:
+                return
+            size -= size % _INDEX.size  # ignore a torn trailing record
+            if size <= self.index_size:
+                return
+            with open(self.index_path, "rb") as index_file:
+                index_file.seek(self.index_size)
+                data = index_file.read(size - self.index_size)
+            for entry in _INDEX.iter_unpack(data):
+                self.entries.append(entry)
+                self.first_keys.append((entry[0], entry[1]))
+                self.last_keys.append((entry[2], entry[3]))
+            self.index_size = size
+            self.by_min_id = sorted((entry[4], position) for position, entry in enumerate(self.entries))
+            self.max_ids = []
+            running = 0
+            for _, position in self.by_min_id:
+                running = max(running, self.entries[position][5])
+                self.max_ids.append(running)
+
+    @property
+    def last_key(self) -> Optional[Key]:
+        return self.last_keys[-1] if self.last_keys else None
+
+    def _block(self, position: int) -> list:
+        entry = self.entries[position]
+        cache_key = (self.space_id, position)
+        with _cache_lock:
+            rows = self.block_cache.get(cache_key)
+            if rows is not None:
+                self.block_cache.move_to_end(cache_key)
+                return rows
+        offset, length = entry[6], entry[7]
+        if self.view is None or len(self.view) < offset + length:
+            self._remap()
+        rows = msgpack.unpackb(zlib.decompress(self.view[offset:offset + length]))
+        with _cache_lock:
+            self.block_cache[cache_key] = rows
+            while len(self.block_cache) > ARCHIVE_BLOCK_CACHE:
+                self.block_cache.popitem(last=False)
+        return rows
+
+    def _remap(self):
+        if self.view is not None:
+            self.view.close()
+        if self.segment_file is None:
+            self.segment_file = open(self.segment_path, "rb")
+        self.view = mmap.mmap(self.segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _row(self, row: list) -> tuple:
+        message_id, sender_id, content, micros, is_deleted = row
+        return (message_id, self.space_id, sender_id, content, from_micros(micros), is_deleted)
+
+    def find(self, message_id: int) -> Optional[tuple]:
+        # Ids are not ordered by time across workers, so block id ranges can
+        # overlap: walk back from the last block starting at or below the id
+        # while some earlier block could still reach it
+        with self.lock:
+            index = bisect_right(self.by_min_id, (message_id, len(self.entries)))
+            while index > 0 and self.max_ids[index - 1] >= message_id:
+                index -= 1
+                position = self.by_min_id[index][1]
+                if self.entries[position][5] < message_id:
+                    continue
+                for row in self._block(position):
+                    if row[0] == message_id:
+                        return self._row(row)
+            return None
+
+    def before(self, key: Optional[Key], limit: int, include_deleted: bool = True) -> List[tuple]:
+        # Up to limit rows older than key (newest archived rows if None), newest first
+        with self.lock:
+            position = len(self.entries) - 1 if key is None else bisect_left(self.first_keys, key) - 1
+            rows = []
+            while position >= 0 and len(rows) < limit:
+                for row in reversed(self._block(position)):
+                    if key is not None and (row[3], row[0]) >= key:
+                        continue
+                    if include_deleted or not row[4]:
+                        rows.append(self._row(row))
+                        if len(rows) == limit:
+                            break
+                position -= 1
+            return rows
+
+    def after(self, key: Key, limit: int, include_deleted: bool = True) -> List[tuple]:
+        # Up to limit rows newer than key, oldest first
+        with self.lock:
+            position = bisect_right(self.last_keys, key)
+            rows = []
+            while position < len(self.entries) and len(rows) < limit:
+                for row in self._block(position):
+                    if (row[3], row[0]) <= key:
+                        continue
+                    if include_deleted or not row[4]:
+                        rows.append(self._row(row))
+                        if len(rows) == limit:
+                            break
+                position += 1
+            return rows
+
+    def append(self, rows: List[list]):
+        # rows in key order and all newer than last_key; durable before returning
+        block = zlib.compress(msgpack.packb(rows))
+        ids = [row[0] for row in rows]
+        with self.lock:
+            with open(self.segment_path, "ab") as segment_file:
+                offset = segment_file.tell()
+                segment_file.write(block)
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+            with open(self.index_path, "ab") as index_file:
+                index_file.write(_INDEX.pack(rows[0][3], rows[0][0], rows[-1][3], rows[-1][0], min(ids), max(ids), offset, len(block)))
+                index_file.flush()
+                os.fsync(index_file.fileno())
+            self.refresh()
+
+    def close(self):
+        with self.lock:
+            if self.view is not None:
+                self.view.close()
+                self.view = None
+            if self.segment_file is not None:
+                self.segment_file.close()
+                self.segment_file = None
+
+
+class MessageArchive:
+    def __init__(self, directory: str = ARCHIVE_DIR, after_days: float = ARCHIVE_AFTER_DAYS, interval: float = ARCHIVE_INTERVAL, block_size: int = ARCHIVE_BLOCK_SIZE):
+        self.directory = directory
+        self.after_days = after_days
+        self.interval = interval
+        self.block_size = block_size
+        self.spaces: Dict[int, SpaceArchive] = {}
+        self.block_cache: "OrderedDict[tuple, list]" = OrderedDict()
+        self.task: Optional[asyncio.Task] = None
+        # Off (and never used before): reads skip the disk entirely
+        self.enabled = after_days > 0 or os.path.isdir(directory)
+
+    def _load(self, space_id: int) -> Optional[SpaceArchive]:
+        archived = self.spaces.get(space_id)
+        if archived is None:
+            if not os.path.exists(os.path.join(self.directory, f"{space_id}.idx")):
+                return None
+            archived = self.spaces.setdefault(space_id, SpaceArchive(self.directory, space_id, self.block_cache))
+        archived.refresh()
+        return archived if archived.entries else None
+
+    async def get(self, space_id: int) -> Optional[SpaceArchive]:
+        # None when the space has nothing archived
+        if not self.enabled:
+            return None
+        return await asyncio.to_thread(self._load, space_id)
+
+    async def find(self, archived: SpaceArchive, message_id: int) -> Optional[tuple]:
+        return await asyncio.to_thread(archived.find, message_id)
+
+    async def before(self, archived: SpaceArchive, key: Optional[Key], limit: int, include_deleted: bool = True) -> List[tuple]:
+        return await asyncio.to_thread(archived.before, key, limit, include_deleted)
+
+    async def after(self, archived: SpaceArchive, key: Key, limit: int, include_deleted: bool = True) -> List[tuple]:
+        return await asyncio.to_thread(archived.after, key, limit, include_deleted)
+
+    async def start(self):
+        if self.after_days > 0 and self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for archived in self.spaces.values():
+            archived.close()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.archive_old_messages()
+            except Exception as e:
+                logger.error("message archival failed", error=str(e))
+
+    def _lock(self):
+        # Only one process on the machine archives at a time
+        import fcntl
+
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = open(os.path.join(self.directory, "archive.lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    async def archive_old_messages(self) -> int:
+        lock_file = self._lock()
+        if lock_file is None:
+            return 0
+        try:
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=self.after_days)
+            async with database.AsyncSessionLocal() as db:
+                space_ids = (await db.execute(select(models.Space.id))).scalars().all()
+            archived = 0
+            for space_id in space_ids:
+                archived += await self._archive_space(space_id, cutoff)
+            if archived:
+                logger.info("messages archived", count=archived)
+            return archived
+        finally:
+            lock_file.close()
+
+    async def _archive_space(self, space_id: int, cutoff: datetime.datetime) -> int:
+        archived = 0
+        while True:
+            async with database.AsyncSessionLocal() as db:
+                result = await db.execute(
+                    select(models.Message.id, models.Message.sender_id, models.Message.content, models.Message.timestamp, models.Message.is_deleted)
+                    .where(models.Message.space_id == space_id, models.Message.timestamp < cutoff)
+                    .order_by(models.Message.timestamp, models.Message.id)
+                    .limit(self.block_size)
+                )
+                rows = [[row.id, row.sender_id, row.content, to_micros(row.timestamp), row.is_deleted or 0] for row in result]
+                if not rows:
+                    return archived
+                space_archive = self.spaces.get(space_id) or self.spaces.setdefault(space_id, SpaceArchive(self.directory, space_id, self.block_cache))
+                await asyncio.to_thread(space_archive.refresh)
+                # Rows at or before the archive's last key can't be appended
+                # (blocks stay in key order). Usually a pass that died before
+                # deleting them already archived them; only ids found in the
+                # segment are deleted, anything else stays in the table.
+                last_key = space_archive.last_key
+                fresh = [row for row in rows if last_key is None or (row[3], row[0]) > last_key]
+                stale = [row for row in rows if last_key is not None and (row[3], row[0]) <= last_key]
+                missing = [row[0] for row in stale if await asyncio.to_thread(space_archive.find, row[0]) is None]
+                if fresh and not missing:
+                    await asyncio.to_thread(space_archive.append, fresh)
+                    durable = [row[0] for row in rows]
+                else:
+                    durable = [row[0] for row in stale if row[0] not in missing]
+                if durable:
+                    await db.execute(delete(models.Message).where(models.Message.id.in_(durable)))
+                    await db.commit()
+            if missing:
+                # These rows would come back at the head of every pass
+                logger.error("archival stopped: rows older than the archive are not in it", space_id=space_id, message_ids=missing[:20])
+                return archived
+            archived += len(fresh)
+            if len(rows) < self.block_size:
+                return archived
+
+message_archive = MessageArchive()
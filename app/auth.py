@@ -1,11 +1,11 @@
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from . import crud, schemas, database
+from . import crud_async, schemas, database, membership, passwords, user_cache
 import os
-import bcrypt
+import time
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
@@ -13,17 +13,9 @@ ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/users/token")
 
-def verify_password(plain_password: str, hashed_password: str):
-    print(f"[DEBUG] Verifying password...")
-    print(f"[DEBUG] Plain password (from form): {plain_password}")
-    print(f"[DEBUG] Hashed password (from DB): {hashed_password}")
-    plain_password_bytes = plain_password.encode('utf-8')
-    hashed_password_bytes = hashed_password.encode('utf-8')
-    print(f"[DEBUG] Plain password (bytes): {plain_password_bytes}")
-    print(f"[DEBUG] Hashed password (bytes): {hashed_password_bytes}")
-    result = bcrypt.checkpw(plain_password_bytes, hashed_password_bytes)
-    print(f"[DEBUG] bcrypt.checkpw result: {result}")
-    return result
+async def verify_password(plain_password: str, hashed_password: str):
+    # Runs on the bcrypt pool; raises 429 when the pool is saturated
+    return await passwords.password_pool.verify(plain_password, hashed_password)
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -32,21 +24,41 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(db: Session = Depends(database.get_db), token: str = Depends(oauth2_scheme)):
+async def get_current_user(db: AsyncSession = Depends(database.get_read_db), token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    username = user_cache.token_cache.get(token)
+    if username is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username: str = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+            token_data = schemas.TokenData(username=username)
+        except JWTError:
             raise credentials_exception
-        token_data = schemas.TokenData(username=username)
-    except JWTError:
-        raise credentials_exception
-    user = crud.get_user_by_username(db, username=token_data.username)
+        # Never trust a cached verification past the token's own expiry
+        expires_in = payload["exp"] - time.time() if "exp" in payload else None
+        user_cache.token_cache.set(token, token_data.username, ttl=expires_in)
+        username = token_data.username
+
+    user = user_cache.user_cache.get(username)
     if user is None:
-        raise credentials_exception
+        db_user = await crud_async.get_user_by_username(db, username=username)
+        if db_user is None:
+            raise credentials_exception
+        user = user_cache.CachedUser.from_orm(db_user)
+        user_cache.user_cache.set(username, user)
     return user
+
+async def require_space_member(
+    space_id: int,
+    db: AsyncSession = Depends(database.get_read_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    if not await membership.membership_index.is_member(db, space_id, current_user.id):
+        raise HTTPException(status_code=403, detail="Not a member of this space")
+    return current_user
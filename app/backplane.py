@@ -0,0 +1,281 @@
+from typing import Callable, Dict, List, Optional, Set, Union
+import asyncio
+import base64
+import json
+import os
+import struct
+
+# Carries broadcasts between processes so every worker can reach the sockets it
+# holds. ConnectionManager delivers to its own sockets directly and publishes to
+# the backplane for everyone else; a backplane never echoes a frame back to the
+# process that published it.
+
+BROADCAST_BACKPLANE = os.getenv("BROADCAST_BACKPLANE", "memory")
+BACKPLANE_SOCKET_PATH = os.getenv("BACKPLANE_SOCKET_PATH", "/tmp/chat-app-backplane.sock")
+BACKPLANE_BATCH_SIZE = int(os.getenv("BACKPLANE_BATCH_SIZE", "500"))
+
+Frame = Union[str, bytes]
+# (space_id, frame, presence)
+DeliverCallback = Callable[[int, Frame, bool], None]
+
+
+class Backplane:
+    # True when frames for a space stop arriving once this process unsubscribes
+    # from it (so local replay buffers can have gaps)
+    cross_process = False
+
+    async def start(self, deliver: DeliverCallback):
+        self.deliver = deliver
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, space_id: int):
+        pass
+
+    def unsubscribe(self, space_id: int):
+        pass
+
+    def publish(self, space_id: int, frame: Frame, presence: bool = False):
+        pass
+
+
+class InProcessBus:
+    def __init__(self):
+        self.subscribers: Dict[int, Set["InProcessBackplane"]] = {}
+
+
+class InProcessBackplane(Backplane):
+    # Connects managers living in the same process (a single worker normally
+    # has just one, which makes publish a no-op).
+    def __init__(self, bus: InProcessBus = None):
+        self.bus = bus or default_bus
+
+    def subscribe(self, space_id: int):
+        self.bus.subscribers.setdefault(space_id, set()).add(self)
+
+    def unsubscribe(self, space_id: int):
+        subscribers = self.bus.subscribers.get(space_id)
+        if subscribers is not None:
+            subscribers.discard(self)
+            if not subscribers:
+                del self.bus.subscribers[space_id]
+
+    def publish(self, space_id: int, frame: Frame, presence: bool = False):
+        for peer in list(self.bus.subscribers.get(space_id, ())):
+            if peer is not self:
+                peer.deliver(space_id, frame, presence)
+
+    async def stop(self):
+        for space_id in [space_id for space_id, peers in self.bus.subscribers.items() if self in peers]:
+            self.unsubscribe(space_id)
+
+default_bus = InProcessBus()
+
+
+# --- Unix socket backplane -------------------------------------------------
+#
+# One worker on the machine hosts a small hub on a Unix socket (elected through
+# an flock on "<path>.lock"); every worker, including the host, connects to it as
+# a client. Records are length-prefixed JSON:
+#   client -> hub: {"ops": [["s", space], ["u", space], ["p", space, kind, data], ...]}
+#   hub -> client: {"frames": [[space, kind, data], ...]}
+# where kind is "t" for text frames, "b" for base64-encoded binary frames and
+# "e" for (text) presence frames.
+# Ops queued during one event loop tick (or up to BACKPLANE_BATCH_SIZE of them)
+# go out as a single record.
+
+_HEADER = struct.Struct("!I")
+
+
+def _pack_frame(frame: Frame, presence: bool = False) -> List:
+    if isinstance(frame, bytes):
+        return ["b", base64.b64encode(frame).decode("ascii")]
+    return ["e" if presence else "t", frame]
+
+
+def _unpack_frame(kind: str, data: str) -> Frame:
+    if kind == "b":
+        return base64.b64decode(data)
+    return data
+
+
+async def _read_record(reader: asyncio.StreamReader) -> dict:
+    header = await reader.readexactly(_HEADER.size)
+    (length,) = _HEADER.unpack(header)
+    return json.loads(await reader.readexactly(length))
+
+
+def _write_record(writer: asyncio.StreamWriter, record: dict):
+    payload = json.dumps(record, separators=(",", ":")).encode("utf-8")
+    writer.write(_HEADER.pack(len(payload)) + payload)
+
+
+class _BackplaneHub:
+    def __init__(self, path: str):
+        self.path = path
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.subscriptions: Dict[asyncio.StreamWriter, Set[int]] = {}
+        self.spaces: Dict[int, Set[asyncio.StreamWriter]] = {}
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._handle, path=self.path)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in list(self.subscriptions):
+            writer.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _unsubscribe(self, writer: asyncio.StreamWriter, space_id: int):
+        self.subscriptions[writer].discard(space_id)
+        peers = self.spaces.get(space_id)
+        if peers is not None:
+            peers.discard(writer)
+            if not peers:
+                del self.spaces[space_id]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.subscriptions[writer] = set()
+        try:
+            while True:
+                record = await _read_record(reader)
+                outgoing: Dict[asyncio.StreamWriter, List] = {}
+                for op in record.get("ops", ()):
+                    if op[0] == "s":
+                        self.subscriptions[writer].add(op[1])
+                        self.spaces.setdefault(op[1], set()).add(writer)
+                    elif op[0] == "u":
+                        self._unsubscribe(writer, op[1])
+                    elif op[0] == "p":
+                        for peer in self.spaces.get(op[1], ()):
+                            if peer is not writer:
+                                outgoing.setdefault(peer, []).append(op[1:])
+                for peer, frames in outgoing.items():
+                    _write_record(peer, {"frames": frames})
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            for space_id in list(self.subscriptions[writer]):
+                self._unsubscribe(writer, space_id)
+            del self.subscriptions[writer]
+            writer.close()
+
+
+class UnixSocketBackplane(Backplane):
+    cross_process = True
+
+    def __init__(self, path: str = BACKPLANE_SOCKET_PATH, batch_size: int = BACKPLANE_BATCH_SIZE, reconnect_delay: float = 0.5):
+        self.path = path
+        self.batch_size = batch_size
+        self.reconnect_delay = reconnect_delay
+        self.subscriptions: Set[int] = set()
+        self.pending: List[List] = []
+        self.flush_scheduled = False
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.hub: Optional[_BackplaneHub] = None
+        self.lock_file = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: DeliverCallback):
+        self.deliver = deliver
+        await self._connect()
+        self.task = asyncio.create_task(self._read_loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        self._flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.hub is not None:
+            await self.hub.stop()
+            self.hub = None
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def _try_become_hub(self) -> bool:
+        import fcntl
+
+        lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    async def _connect(self):
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if self.hub is None and self._try_become_hub():
+                    self.hub = _BackplaneHub(self.path)
+                    await self.hub.start()
+                    continue
+                await asyncio.sleep(self.reconnect_delay)
+        # A fresh hub knows nothing about us, so replay our subscriptions
+        self.pending = [["s", space_id] for space_id in self.subscriptions]
+        self._flush()
+
+    async def _read_loop(self):
+        while True:
+            try:
+                record = await _read_record(self.reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.writer = None
+                self.pending = []
+                await asyncio.sleep(self.reconnect_delay)
+                await self._connect()
+                continue
+            for space_id, kind, data in record.get("frames", ()):
+                self.deliver(space_id, _unpack_frame(kind, data), kind == "e")
+
+    def _queue_op(self, op: List):
+        self.pending.append(op)
+        if len(self.pending) >= self.batch_size:
+            self._flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        self.flush_scheduled = False
+        if self.writer is None:
+            # Local sockets were already served; subscriptions are replayed on reconnect
+            self.pending = []
+            return
+        if not self.pending:
+            return
+        ops, self.pending = self.pending, []
+        _write_record(self.writer, {"ops": ops})
+
+    def subscribe(self, space_id: int):
+        self.subscriptions.add(space_id)
+        self._queue_op(["s", space_id])
+
+    def unsubscribe(self, space_id: int):
+        self.subscriptions.discard(space_id)
+        self._queue_op(["u", space_id])
+
+    def publish(self, space_id: int, frame: Frame, presence: bool = False):
+        self._queue_op(["p", space_id] + _pack_frame(frame, presence))
+
+
+def backplane_from_env() -> Backplane:
+    if BROADCAST_BACKPLANE == "unix":
+        return UnixSocketBackplane()
+    if BROADCAST_BACKPLANE == "memory":
+        return InProcessBackplane()
+    raise ValueError(f"Unknown broadcast backplane: {BROADCAST_BACKPLANE}")
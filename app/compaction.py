@@ -0,0 +1,90 @@
+from typing import Optional
+from sqlalchemy import delete, select, update
+from . import database, models
+from .log import get_logger
+import asyncio
+import datetime
+import os
+
+# Background upkeep for deleted messages. Deletes already keep only a
+# tombstone (content NULL); each pass here, in batches of COMPACTION_BATCH_SIZE:
+#   - clears the ciphertext of tombstones written before that was the case
+#   - removes tombstones older than TOMBSTONE_RETENTION_DAYS (0 keeps them)
+# Both walk the partial index on tombstones, so a pass costs in proportion to
+# the deleted rows, not the table. Freed pages are reused by later inserts.
+
+COMPACTION_INTERVAL = float(os.getenv("COMPACTION_INTERVAL", "3600"))
+COMPACTION_BATCH_SIZE = int(os.getenv("COMPACTION_BATCH_SIZE", "500"))
+TOMBSTONE_RETENTION_DAYS = float(os.getenv("TOMBSTONE_RETENTION_DAYS", "30"))
+
+logger = get_logger(__name__)
+
+
+class TombstoneCompactor:
+    def __init__(self, interval: float = COMPACTION_INTERVAL, batch_size: int = COMPACTION_BATCH_SIZE, retention_days: float = TOMBSTONE_RETENTION_DAYS):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.retention_days = retention_days
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.interval > 0 and self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.compact()
+            except Exception as e:
+                logger.error("tombstone compaction failed", error=str(e))
+
+    async def _batches(self, statement_for) -> int:
+        # Run statement_for(ids) over successive batches until nothing is left
+        total = 0
+        while True:
+            async with database.AsyncSessionLocal() as db:
+                ids = (await db.execute(statement_for(None))).scalars().all()
+                if not ids:
+                    return total
+                await db.execute(statement_for(ids))
+                await db.commit()
+            total += len(ids)
+            if len(ids) < self.batch_size:
+                return total
+            # Let the write-behind ingestor get at the database between batches
+            await asyncio.sleep(0)
+
+    async def compact(self) -> dict:
+        tombstones = models.Message.is_deleted == 1
+
+        def clear(ids):
+            if ids is None:
+                return select(models.Message.id).where(tombstones, models.Message.content.is_not(None)).limit(self.batch_size)
+            return update(models.Message).where(models.Message.id.in_(ids)).values(content=None)
+
+        cleared = await self._batches(clear)
+        purged = 0
+        if self.retention_days > 0:
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=self.retention_days)
+
+            def purge(ids):
+                if ids is None:
+                    return select(models.Message.id).where(tombstones, models.Message.timestamp < cutoff).limit(self.batch_size)
+                return delete(models.Message).where(models.Message.id.in_(ids))
+
+            purged = await self._batches(purge)
+        if cleared or purged:
+            logger.info("tombstones compacted", cleared=cleared, purged=purged)
+        return {"cleared": cleared, "purged": purged}
+
+tombstone_compactor = TombstoneCompactor()
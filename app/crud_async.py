@@ -0,0 +1,189 @@
+from sqlalchemy import insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import archive, membership, models, schemas, user_cache
+from .crud import MESSAGE_PAGE_DEFAULT, delete_message_statement, message_cursor_statement, message_page_statement
+import datetime
+
+# Database access for the async routes and the WebSocket endpoint; crud.py
+# only holds the shared history statements. Writes go through
+# database.get_async_db, reads may use database.get_read_db.
+
+async def get_user_by_username(db: AsyncSession, username: str):
+    result = await db.execute(select(models.User).where(models.User.username == username))
+    return result.scalars().first()
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate, hashed_password: str):
+    # Hash with passwords.password_pool first; bcrypt never runs here
+    db_user = models.User(
+        username=user.username,
+        display_name=user.display_name,
+        hashed_password=hashed_password,
+        public_key=user.public_key,
+        avatar=user.avatar
+    )
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    return db_user
+
+async def update_user_password(db: AsyncSession, user_id: int, new_hashed_password: str):
+    db_user = await db.get(models.User, user_id)
+    if db_user:
+        db_user.hashed_password = new_hashed_password
+        await db.commit()
+        await db.refresh(db_user)
+        user_cache.invalidate_user(db_user.username)
+    return db_user
+
+async def create_space(db: AsyncSession, space: schemas.SpaceCreate, user_id: int, encrypted_space_key: str):
+    db_space = models.Space(**space.dict(), created_by=user_id)
+    db.add(db_space)
+    await db.flush()
+    db.add(models.SpaceMember(
+        space_id=db_space.id,
+        user_id=user_id,
+        encrypted_space_key=encrypted_space_key
+    ))
+    await db.commit()
+    await db.refresh(db_space)
+    membership.membership_index.add(db_space.id, user_id)
+    return db_space
+
+async def add_user_to_space(db: AsyncSession, space_id: int, user_id: int, encrypted_space_key: str):
+    db_space_member = models.SpaceMember(
+        space_id=space_id,
+        user_id=user_id,
+        encrypted_space_key=encrypted_space_key
+    )
+    db.add(db_space_member)
+    await db.commit()
+    await db.refresh(db_space_member)
+    membership.membership_index.add(space_id, user_id)
+    return db_space_member
+
+# Rows per IN (...) list or multi-row insert, well under SQLite's parameter limit
+BULK_CHUNK_SIZE = 500
+
+async def get_user_ids_by_username(db: AsyncSession, usernames: list) -> dict:
+    user_ids = {}
+    for start in range(0, len(usernames), BULK_CHUNK_SIZE):
+        chunk = usernames[start:start + BULK_CHUNK_SIZE]
+        result = await db.execute(select(models.User.username, models.User.id).where(models.User.username.in_(chunk)))
+        user_ids.update(result.all())
+    return user_ids
+
+async def get_users_by_usernames(db: AsyncSession, usernames: list) -> list:
+    users = []
+    for start in range(0, len(usernames), BULK_CHUNK_SIZE):
+        chunk = usernames[start:start + BULK_CHUNK_SIZE]
+        result = await db.execute(select(models.User).where(models.User.username.in_(chunk)))
+        users.extend(result.scalars())
+    return users
+
+async def get_member_ids(db: AsyncSession, space_id: int, user_ids: list) -> set:
+    member_ids = set()
+    for start in range(0, len(user_ids), BULK_CHUNK_SIZE):
+        chunk = user_ids[start:start + BULK_CHUNK_SIZE]
+        result = await db.execute(
+            select(models.SpaceMember.user_id)
+            .where(models.SpaceMember.space_id == space_id, models.SpaceMember.user_id.in_(chunk))
+        )
+        member_ids.update(result.scalars())
+    return member_ids
+
+async def insert_space_members(db: AsyncSession, space_id: int, members: list):
+    # members: (user_id, encrypted_space_key) pairs. Doesn't commit, so a whole
+    # bulk add lands in one transaction; update membership_index after commit.
+    await db.execute(insert(models.SpaceMember), [
+        {"space_id": space_id, "user_id": user_id, "encrypted_space_key": encrypted_space_key}
+        for user_id, encrypted_space_key in members
+    ])
+
+async def mark_space_read(db: AsyncSession, space_id: int, user_id: int, message_id: int = None):
+    if message_id is None:
+        read_at = datetime.datetime.utcnow()
+    else:
+        read_at = (await db.execute(
+            select(models.Message.timestamp).where(models.Message.id == message_id, models.Message.space_id == space_id)
+        )).scalar()
+        if read_at is None:
+            return None
+    await db.execute(
+        update(models.SpaceMember)
+        .where(models.SpaceMember.space_id == space_id, models.SpaceMember.user_id == user_id)
+        .values(last_read_at=read_at)
+    )
+    await db.commit()
+    return read_at
+
+async def get_message_timestamp(db: AsyncSession, space_id: int, message_id: int):
+    # Timestamp of a message in the table or the archive, or None if it's gone
+    cursor = (await db.execute(message_cursor_statement(space_id, message_id))).first()
+    if cursor is not None:
+        return cursor.timestamp
+    archived = await archive.message_archive.get(space_id)
+    row = await archive.message_archive.find(archived, message_id) if archived is not None else None
+    return row[4] if row is not None else None
+
+async def _with_display_names(db: AsyncSession, rows: list) -> list:
+    # Archived rows carry sender ids only; names are looked up as they're read
+    sender_ids = {row[2] for row in rows}
+    result = await db.execute(select(models.User.id, models.User.display_name).where(models.User.id.in_(sender_ids)))
+    names = dict(result.all())
+    return [row + (names.get(row[2]),) for row in rows]
+
+async def get_space_member_rows(db: AsyncSession, space_id: int):
+    # Plain (username, display_name, public_key, avatar, id) tuples
+    result = await db.execute(
+        select(models.User.username, models.User.display_name, models.User.public_key, models.User.avatar, models.User.id)
+        .join(models.SpaceMember).where(models.SpaceMember.space_id == space_id)
+    )
+    return result.all()
+
+async def get_messages_for_space(db: AsyncSession, space_id: int, before_id: int = None, after_id: int = None, limit: int = MESSAGE_PAGE_DEFAULT, include_deleted: bool = True):
+    # Pages run across the messages table and the space's archive, whose rows
+    # are all older than the table's
+    archived = await archive.message_archive.get(space_id)
+    cursor_ts = None
+    cursor_id = after_id if after_id is not None else before_id
+    if cursor_id is not None:
+        cursor_ts = await get_message_timestamp(db, space_id, cursor_id)
+        if cursor_ts is None:
+            # Unknown or purged cursor: there's no page to anchor, not an empty one
+            return None
+
+    if after_id is not None:
+        rows = []
+        if archived is not None:
+            rows = await _with_display_names(db, await archive.message_archive.after(archived, (archive.to_micros(cursor_ts), after_id), limit, include_deleted))
+        if len(rows) < limit:
+            rows += (await db.execute(message_page_statement(space_id, limit - len(rows), cursor_ts, before_id, after_id, include_deleted))).all()
+        return rows
+
+    rows = (await db.execute(message_page_statement(space_id, limit, cursor_ts, before_id, after_id, include_deleted))).all()
+    if len(rows) < limit and archived is not None:
+        key = (archive.to_micros(cursor_ts), before_id) if before_id is not None else None
+        rows += await _with_display_names(db, await archive.message_archive.before(archived, key, limit - len(rows), include_deleted))
+    rows.reverse()
+    return rows
+
+async def get_message(db: AsyncSession, message_id: int):
+    return await db.get(models.Message, message_id)
+
+async def find_archived_message(db: AsyncSession, user_id: int, message_id: int):
+    # Archives are per space and a bare id doesn't say which, so look in the
+    # user's spaces; returns the archived row tuple or None
+    result = await db.execute(select(models.SpaceMember.space_id).where(models.SpaceMember.user_id == user_id))
+    for space_id in result.scalars().all():
+        archived = await archive.message_archive.get(space_id)
+        if archived is None:
+            continue
+        row = await archive.message_archive.find(archived, message_id)
+        if row is not None:
+            return row
+    return None
+
+async def delete_message(db: AsyncSession, message_id: int):
+    await db.execute(delete_message_statement(message_id))
+    await db.commit()
+    return await db.get(models.Message, message_id, populate_existing=True)
@@ -1,21 +1,133 @@
-from sqlalchemy import create_engine
+from sqlalchemy import Column, MetaData, String, Table, create_engine, delete, exc, insert, inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.schema import CreateIndex, CreateTable
+import hashlib
 import os
-from dotenv import load_dotenv
+from . import metrics, storage
+from .log import get_logger
 
-load_dotenv()
+logger = get_logger(__name__)
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Pool policy for the async engine (also applies as-is to Postgres)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
+
+def to_async_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    if "+" in scheme:
+        return url
+    return ASYNC_DRIVERS.get(scheme, scheme) + sep + rest
+
+IS_SQLITE = storage.is_sqlite(DATABASE_URL)
+
+def _async_engine(pool_size: int, max_overflow: int):
+    return create_async_engine(
+        to_async_url(DATABASE_URL),
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_pre_ping=True,
+    )
+
+# Only used by ensure_schema at startup; every request-time write goes
+# through async_engine
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Writes (AsyncSessionLocal / get_async_db, and the ingestor) and reads
+# (ReadSessionLocal / get_read_db) use separate engines. On SQLite the write
+# pool is one connection, so writers queue here instead of on the file lock,
+# while WAL lets the read pool run alongside. Elsewhere both are one engine.
+if IS_SQLITE:
+    async_engine = _async_engine(pool_size=1, max_overflow=0)
+    async_read_engine = _async_engine(pool_size=storage.SQLITE_READ_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+    storage.apply_sqlite_profile(engine)
+    storage.apply_sqlite_profile(async_engine.sync_engine)
+    storage.apply_sqlite_profile(async_read_engine.sync_engine, read_only=True)
+else:
+    async_engine = async_read_engine = _async_engine(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+metrics.instrument_engine(engine)
+metrics.instrument_engine(async_engine.sync_engine)
+if async_read_engine is not async_engine:
+    metrics.instrument_engine(async_read_engine.sync_engine)
+
+AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+ReadSessionLocal = sessionmaker(async_read_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+async def get_read_db():
+    # Read-only work; a session that writes must use get_async_db
+    async with ReadSessionLocal() as db:
+        yield db
+
+# Fingerprint of the schema the database was last brought up to date with
+_schema_state = Table("schema_state", MetaData(), Column("fingerprint", String, nullable=False))
+
+def schema_fingerprint(metadata) -> str:
+    ddl = []
+    for table in metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=engine.dialect)))
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            ddl.append(str(CreateIndex(index).compile(dialect=engine.dialect)))
+    return hashlib.sha256("\n".join(ddl).encode()).hexdigest()
+
+def ensure_schema(metadata):
+    # A single query on a normal start; the full sync_schema pass only runs
+    # when the models have changed since the last one that completed
+    fingerprint = schema_fingerprint(metadata)
+    try:
+        with engine.connect() as conn:
+            current = conn.execute(select(_schema_state.c.fingerprint)).scalar()
+    except exc.DBAPIError:
+        current = None
+    if current == fingerprint:
+        return
+    if sync_schema(metadata):
+        with engine.begin() as conn:
+            _schema_state.create(conn, checkfirst=True)
+            conn.execute(delete(_schema_state))
+            conn.execute(insert(_schema_state).values(fingerprint=fingerprint))
+        logger.info("schema updated", fingerprint=fingerprint)
+
+def sync_schema(metadata) -> bool:
+    # Returns False if anything was left undone (it's retried next start)
+    metadata.create_all(bind=engine)
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        # create_all only creates missing tables, so bring existing ones up to
+        # date: add new nullable columns, then any new indexes
+        for table in metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+    complete = True
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except exc.SQLAlchemyError as e:
+                # e.g. duplicate rows left over from before a unique index existed
+                logger.warning("could not create index", index=index.name, error=str(e))
+                complete = False
+    return complete
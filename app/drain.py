@@ -0,0 +1,84 @@
+from typing import Optional
+from . import ingest, metrics, websocket_manager
+from .log import get_logger
+import asyncio
+import os
+import signal
+import threading
+import time
+
+# Graceful drain for deploys. uvicorn answers SIGTERM by failing every open
+# WebSocket at once, and the clients then stampede the next worker. So the
+# signal is intercepted first: this worker stops taking sockets (and /healthz
+# reports 503 so load balancers stop routing here), lands queued messages so
+# clients can catch up from the database wherever they reconnect, runs
+# ConnectionManager.drain and lands whatever arrived meanwhile. Only then is
+# the signal passed on to whatever handler was installed before, and the
+# normal shutdown proceeds. A second signal skips the drain.
+
+WS_DRAIN_SIGNALS = [name.strip() for name in os.getenv("WS_DRAIN_SIGNALS", "SIGTERM").split(",") if name.strip()]
+
+logger = get_logger(__name__)
+
+
+class DrainController:
+    def __init__(self, manager: websocket_manager.ConnectionManager, signal_names=WS_DRAIN_SIGNALS):
+        self.manager = manager
+        self.signals = [getattr(signal, name) for name in signal_names if hasattr(signal, name)]
+        self.previous = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def draining(self) -> bool:
+        return self.manager.draining
+
+    def install(self):
+        # Called from startup, after the server has installed its own handlers.
+        # Signals can only be handled on the main thread (not, e.g., under a
+        # test client running the app in a worker thread)
+        if self.manager.drain_timeout <= 0 or threading.current_thread() is not threading.main_thread():
+            return
+        self.loop = asyncio.get_running_loop()
+        for signum in self.signals:
+            self.previous[signum] = signal.getsignal(signum)
+            signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        if self.task is not None:
+            self._pass_on(signum)
+            return
+        self.loop.call_soon_threadsafe(self._start, signum)
+
+    def _start(self, signum):
+        if self.task is None:
+            self.task = asyncio.create_task(self._drain(signum))
+
+    async def _drain(self, signum):
+        start = time.perf_counter()
+        connections = len(self.manager.writers)
+        logger.info("draining", connections=connections)
+        try:
+            self.manager.draining = True
+            await ingest.message_ingestor.flush()
+            await self.manager.drain()
+            # Sockets kept sending until they were closed; land those messages
+            # too before anyone catches up elsewhere
+            await ingest.message_ingestor.flush()
+        except Exception as e:
+            logger.error("drain failed", error=str(e))
+        logger.info("drained", connections=connections, seconds=round(time.perf_counter() - start, 3))
+        self._pass_on(signum)
+
+    def _pass_on(self, signum):
+        # Restore the original handlers and deliver the signal to them
+        for other, handler in self.previous.items():
+            signal.signal(other, handler)
+        self.previous = {}
+        signal.raise_signal(signum)
+
+drain_controller = DrainController(websocket_manager.manager)
+
+metrics.CallbackGauge(
+    "ws_draining", "1 while this worker is draining its WebSockets",
+    lambda: [((), int(drain_controller.draining))])
@@ -0,0 +1,224 @@
+from typing import Dict, List, Optional
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from . import database, models, space_view
+from .log import get_logger
+import asyncio
+import datetime
+import os
+
+# Write-behind ingestion for chat messages. Callers get a fully formed row
+# (id and timestamp assigned up front) and can broadcast it immediately; rows
+# are persisted in group commits of up to INGEST_BATCH_SIZE rows, or whatever
+# has accumulated after INGEST_FLUSH_INTERVAL_MS.
+#
+# Ids come from blocks reserved in the id_sequences table, so several workers
+# can ingest into the same database without colliding. While the pipeline is
+# running, every message insert should go through it.
+#
+# Accepted messages have already been broadcast, so a failed write is never
+# given up on: whatever the error (a locked database, a full disk, a pool
+# timeout), the batch is retried with backoff (up to INGEST_RETRY_MAX_DELAY
+# seconds apart) until it lands, while submit() applies backpressure. Only a
+# constraint violation is final, and then just for the offending rows. Rows
+# count as written once their insert has committed, never before.
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_INTERVAL_MS = float(os.getenv("INGEST_FLUSH_INTERVAL_MS", "10"))
+INGEST_ID_BLOCK_SIZE = int(os.getenv("INGEST_ID_BLOCK_SIZE", "1000"))
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "10000"))
+INGEST_RETRY_DELAY = 0.05
+INGEST_RETRY_MAX_DELAY = float(os.getenv("INGEST_RETRY_MAX_DELAY", "5"))
+
+MESSAGE_SEQUENCE = "messages"
+
+logger = get_logger(__name__)
+
+
+class MessageIngestor:
+    def __init__(self, batch_size: int = INGEST_BATCH_SIZE, flush_interval_ms: float = INGEST_FLUSH_INTERVAL_MS, id_block_size: int = INGEST_ID_BLOCK_SIZE, max_pending: int = INGEST_MAX_PENDING):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.id_block_size = id_block_size
+        self.max_pending = max_pending
+        self.pending: List[Dict] = []
+        self.pending_by_space: Dict[int, int] = {}
+        self.next_id = 0
+        self.block_end = 0
+        self.id_lock: Optional[asyncio.Lock] = None
+        self.wakeup: Optional[asyncio.Event] = None
+        self.idle: Optional[asyncio.Event] = None
+        self.writes_in_flight = 0
+        self.drained: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.closing = False
+
+    async def start(self):
+        self.id_lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self.closing = False
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Durable shutdown: refuse nothing already accepted, write it all out
+        self.closing = True
+        if self.task is not None:
+            self.wakeup.set()
+            await self.task
+            self.task = None
+
+    async def submit(self, space_id: int, sender_id: int, content: str) -> Dict:
+        if self.task is None or self.task.done():
+            raise RuntimeError("Message ingestor is not running")
+        while len(self.pending) >= self.max_pending:
+            # Backpressure: the writer is behind, wait for the next commit
+            self.drained.clear()
+            await self.drained.wait()
+        row = {
+            "id": await self._next_message_id(),
+            "space_id": space_id,
+            "sender_id": sender_id,
+            "content": content,
+            "timestamp": datetime.datetime.utcnow(),
+            "is_deleted": 0,
+        }
+        self.pending.append(row)
+        self.pending_by_space[space_id] = self.pending_by_space.get(space_id, 0) + 1
+        self.wakeup.set()
+        # Every accepted message passes through here, so keep sidebars current
+        space_view.my_spaces.on_message(row)
+        return row
+
+    def has_pending(self, space_id: int) -> bool:
+        return space_id in self.pending_by_space
+
+    async def flush(self):
+        # Write everything accepted so far, e.g. before reading it back
+        while self.pending:
+            await self._write_batch(self._take_batch())
+        # Batches already taken by the writer task must land too
+        if self.idle is not None:
+            await self.idle.wait()
+
+    async def _next_message_id(self) -> int:
+        async with self.id_lock:
+            if self.next_id >= self.block_end:
+                self.next_id = await self._reserve_id_block()
+                self.block_end = self.next_id + self.id_block_size
+            message_id = self.next_id
+            self.next_id += 1
+            return message_id
+
+    async def _reserve_id_block(self) -> int:
+        size = self.id_block_size
+        sequence = models.IdSequence
+        delay = INGEST_RETRY_DELAY
+        while True:
+            try:
+                async with database.async_engine.begin() as conn:
+                    # UPDATE first so the read below happens under the write lock
+                    result = await conn.execute(
+                        update(sequence)
+                        .where(sequence.name == MESSAGE_SEQUENCE)
+                        .values(next_value=sequence.next_value + size)
+                    )
+                    if result.rowcount:
+                        next_value = (await conn.execute(
+                            select(sequence.next_value).where(sequence.name == MESSAGE_SEQUENCE)
+                        )).scalar_one()
+                        return next_value - size
+                    max_id = (await conn.execute(select(func.max(models.Message.id)))).scalar() or 0
+                    await conn.execute(insert(sequence).values(name=MESSAGE_SEQUENCE, next_value=max_id + 1 + size))
+                    return max_id + 1
+            except IntegrityError:
+                # Another worker created the sequence row first; take a block from it
+                continue
+            except Exception as e:
+                logger.warning("id block reservation failed, retrying", delay=delay, error=str(e))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, INGEST_RETRY_MAX_DELAY)
+
+    def _take_batch(self) -> List[Dict]:
+        batch = self.pending[:self.batch_size]
+        del self.pending[:self.batch_size]
+        return batch
+
+    def _mark_written(self, rows: List[Dict]):
+        for row in rows:
+            count = self.pending_by_space[row["space_id"]] - 1
+            if count:
+                self.pending_by_space[row["space_id"]] = count
+            else:
+                del self.pending_by_space[row["space_id"]]
+
+    async def _run(self):
+        while True:
+            await self.wakeup.wait()
+            try:
+                if not self.closing and len(self.pending) < self.batch_size:
+                    # Give the batch a moment to fill up
+                    await asyncio.sleep(self.flush_interval)
+                self.wakeup.clear()
+                while self.pending:
+                    await self._write_batch(self._take_batch())
+            except Exception as e:
+                # The batch went back on the queue; this task must outlive it
+                logger.error("message writer failed, retrying", error=str(e))
+                self.wakeup.set()
+                await asyncio.sleep(INGEST_RETRY_DELAY)
+                continue
+            self.drained.set()
+            if self.closing:
+                return
+
+    async def _write_batch(self, rows: List[Dict]):
+        self.writes_in_flight += 1
+        self.idle.clear()
+        try:
+            await self._insert_rows(rows)
+        except BaseException:
+            # Not written (e.g. cancelled): put the rows back, in order
+            self.pending[:0] = rows
+            raise
+        else:
+            self._mark_written(rows)
+        finally:
+            self.writes_in_flight -= 1
+            if not self.writes_in_flight:
+                self.idle.set()
+
+    async def _insert_rows(self, rows: List[Dict]):
+        try:
+            await self._insert_with_retry(rows)
+            return
+        except IntegrityError:
+            pass
+        # Isolate bad rows so one of them can't sink the rest of the batch
+        for row in rows:
+            try:
+                await self._insert_with_retry([row])
+            except IntegrityError as e:
+                logger.error("dropping message", message_id=row["id"], space_id=row["space_id"], error=str(e))
+
+    async def _insert_with_retry(self, rows: List[Dict]):
+        # Retries until the insert commits; only IntegrityError gets through.
+        # Anything else, including pool timeouts, may clear up on its own.
+        delay = INGEST_RETRY_DELAY
+        while True:
+            try:
+                async with database.async_engine.begin() as conn:
+                    await conn.execute(insert(models.Message), rows)
+                return
+            except IntegrityError:
+                raise
+            except Exception as e:
+                # Usually "database is locked", a full disk or a pool timeout; keep the rows
+                logger.warning("message write failed, retrying", rows=len(rows), delay=delay, error=str(e))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, INGEST_RETRY_MAX_DELAY)
+
+message_ingestor = MessageIngestor()
@@ -0,0 +1,65 @@
+from logging.handlers import QueueHandler, QueueListener
+import json
+import logging
+import os
+import queue
+import random
+
+# Leveled, structured logging. Records are JSON lines handed to a background
+# thread through a queue, so the event loop never blocks on stdout/stderr.
+# Debug records are dropped early when the level is above DEBUG and are sampled
+# at LOG_DEBUG_SAMPLE_RATE when it isn't.
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1.0"))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, default=str)
+
+
+class StructLogger:
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+
+    def _log(self, level: int, event: str, fields: dict):
+        self.logger.log(level, event, extra={"fields": fields})
+
+    def debug(self, event: str, **fields):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        if LOG_DEBUG_SAMPLE_RATE < 1.0 and random.random() >= LOG_DEBUG_SAMPLE_RATE:
+            return
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event: str, **fields):
+        if self.logger.isEnabledFor(logging.INFO):
+            self._log(logging.INFO, event, fields)
+
+    def warning(self, event: str, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event: str, **fields):
+        self._log(logging.ERROR, event, fields)
+
+
+_root = logging.getLogger("app")
+_root.setLevel(LOG_LEVEL)
+_root.propagate = False
+_queue: "queue.SimpleQueue" = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(JsonFormatter())
+_root.addHandler(QueueHandler(_queue))
+_listener = QueueListener(_queue, _stream_handler)
+_listener.start()
+
+def get_logger(name: str) -> StructLogger:
+    return StructLogger(logging.getLogger(name))
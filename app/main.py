@@ -1,8 +1,22 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, status
-from sqlalchemy.orm import Session
-from . import models, database, websocket_manager, auth, crud
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect, Depends, status
+from typing import Optional
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.websockets import WebSocketState
+from . import models, database, websocket_manager, archive, auth, crud, crud_async, compaction, drain, ingest, membership, metrics, schemas, passwords, serializers, rate_limit, presence
 from .routers import users, spaces, messages
 from fastapi.middleware.cors import CORSMiddleware
+import hmac
+import json
+import os
+
+# Persist text frames received on /ws/{space_id} as messages instead of only relaying them
+WS_PERSIST_FRAMES = os.getenv("WS_PERSIST_FRAMES", "false").lower() == "true"
+# Most messages a reconnecting socket is sent from the database before it's told to resync
+WS_CATCHUP_MAX_MESSAGES = int(os.getenv("WS_CATCHUP_MAX_MESSAGES", "1000"))
+# Consecutive rate-limited frames after which a socket is closed (0 never closes)
+WS_THROTTLE_CLOSE_AFTER = int(os.getenv("WS_THROTTLE_CLOSE_AFTER", "50"))
+# Bearer token required on /metrics; unset, only loopback clients may scrape it
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
 
 app = FastAPI()
 
@@ -20,36 +34,234 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(metrics.MetricsMiddleware)
+
 # Include routers
 app.include_router(users.router)
 app.include_router(spaces.router)
 app.include_router(messages.router)
 
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def read_metrics(request: Request):
+    # Per-space connection counts are not for the public internet
+    if METRICS_TOKEN:
+        allowed = hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}")
+    else:
+        allowed = request.client is not None and request.client.host in ("127.0.0.1", "::1")
+    if not allowed:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/healthz", include_in_schema=False)
+def read_health():
+    # Load balancers stop routing here as soon as a drain starts
+    if websocket_manager.manager.draining:
+        return JSONResponse({"status": "draining"}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return {"status": "ok"}
+
 @app.on_event("startup")
 def on_startup():
-    models.Base.metadata.create_all(bind=database.engine)
+    database.ensure_schema(models.Base.metadata)
+
+@app.on_event("startup")
+async def start_websocket_manager():
+    await websocket_manager.manager.start()
+    await ingest.message_ingestor.start()
+    await presence.presence.start()
+    await compaction.tombstone_compactor.start()
+    await archive.message_archive.start()
+    await passwords.password_pool.start()
+    drain.drain_controller.install()
+
+@app.on_event("shutdown")
+async def stop_websocket_manager():
+    await archive.message_archive.stop()
+    await compaction.tombstone_compactor.stop()
+    await presence.presence.stop()
+    await ingest.message_ingestor.stop()
+    await websocket_manager.manager.stop()
+    await passwords.password_pool.stop()
 
 @app.websocket("/ws/{space_id}")
 async def websocket_endpoint(
     websocket: WebSocket,
     space_id: int,
     token: str,
-    db: Session = Depends(database.get_db)
+    last_seq: Optional[int] = None,
+    epoch: Optional[str] = None,
+    last_message_id: Optional[int] = None,
+    encoding: str = serializers.ENCODING_JSON,
+    presence: bool = False,
+    binary_content: bool = False
 ):
+    if websocket_manager.manager.draining:
+        await websocket.close(code=status.WS_1012_SERVICE_RESTART)
+        return
+    if encoding not in serializers.ENCODINGS:
+        await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
+        return
+    # Use a short-lived session so the socket doesn't pin a pooled connection
     try:
-        current_user = auth.get_current_user(db=db, token=token)
+        async with database.ReadSessionLocal() as db:
+            current_user = await auth.get_current_user(db=db, token=token)
+            is_member = await membership.membership_index.is_member(db, space_id, current_user.id)
     except Exception as e:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
+    if not is_member:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
 
-    # TODO: Verify if current_user is a member of space_id
-
-    await websocket_manager.manager.connect(websocket, space_id)
+    # Reconnects resume from this worker's replay buffer when they can
+    resumed = await websocket_manager.manager.connect(websocket, space_id, last_seq=last_seq, epoch=epoch, user_id=current_user.id, encoding=encoding, presence=presence, binary_content=binary_content)
+    if not resumed or (last_seq is None and last_message_id is not None):
+        # Live frames wait until the missed ones are queued; one can still arrive twice (dedupe by id)
+        await send_catchup(websocket, space_id, last_message_id)
+    throttled = 0
     try:
-        while True:
+        # The server may close the socket itself (drain, slow or dead writer)
+        while websocket.application_state == WebSocketState.CONNECTED:
             data = await websocket.receive_text()
-            # Messages are already encrypted on the client-side
-            # The backend just broadcasts them
-            await websocket_manager.manager.broadcast(data, space_id)
+            if is_typing_frame(data):
+                # {"type": "typing"}: feeds presence, never relayed. (The
+                # presence module is shadowed by the query parameter here.)
+                if websocket_manager.manager.presence is not None:
+                    websocket_manager.manager.presence.set_typing(space_id, current_user.id)
+                continue
+            throttled = 0 if await relay_frame(websocket, space_id, current_user, data) else throttled + 1
+            if WS_THROTTLE_CLOSE_AFTER and throttled >= WS_THROTTLE_CLOSE_AFTER:
+                websocket_manager.manager.drop(websocket, close_code=status.WS_1008_POLICY_VIOLATION)
+                break
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Idempotent: the writer may already have dropped a dead or slow socket
         websocket_manager.manager.disconnect(websocket, space_id)
+
+@app.websocket("/ws")
+async def multiplexed_websocket_endpoint(websocket: WebSocket, token: str, encoding: str = serializers.ENCODING_JSON, binary_content: bool = False):
+    # One socket for all of a user's spaces, driven by JSON control frames:
+    #   {"type": "subscribe", "space_id", "last_seq"?, "epoch"?, "last_message_id"?}
+    #   {"type": "unsubscribe", "space_id"}
+    #   {"type": "send", "space_id", "data"}
+    #   {"type": "typing", "space_id"}
+    # Outbound frames are {"space_id", "seq", "data"} envelopes, or binary
+    # frames with ?encoding=msgpack (see serializers).
+    if websocket_manager.manager.draining:
+        await websocket.close(code=status.WS_1012_SERVICE_RESTART)
+        return
+    if encoding not in serializers.ENCODINGS:
+        await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
+        return
+    try:
+        async with database.ReadSessionLocal() as db:
+            current_user = await auth.get_current_user(db=db, token=token)
+    except Exception as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    manager = websocket_manager.manager
+    writer = await manager.accept(websocket, user_id=current_user.id, multiplexed=True, encoding=encoding, binary_content=binary_content)
+    throttled = 0
+    try:
+        while websocket.application_state == WebSocketState.CONNECTED:
+            text = await websocket.receive_text()
+            try:
+                control = json.loads(text)
+                kind = control["type"]
+                space_id = int(control["space_id"])
+            except (ValueError, KeyError, TypeError):
+                manager.send(websocket, '{"type":"error","detail":"Malformed control frame"}')
+                continue
+
+            if kind == "subscribe":
+                async with database.ReadSessionLocal() as db:
+                    is_member = await membership.membership_index.is_member(db, space_id, current_user.id)
+                if not is_member:
+                    manager.send(websocket, json.dumps({"type": "error", "space_id": space_id, "detail": "Not a member of this space"}))
+                    continue
+                last_seq = control.get("last_seq")
+                last_message_id = control.get("last_message_id")
+                resumed = manager.subscribe(websocket, space_id, last_seq=last_seq, epoch=control.get("epoch"))
+                if not resumed or (last_seq is None and last_message_id is not None):
+                    await send_catchup(websocket, space_id, last_message_id)
+            elif kind == "unsubscribe":
+                manager.unsubscribe(websocket, space_id)
+            elif kind == "typing" and space_id in writer.spaces:
+                presence.presence.set_typing(space_id, current_user.id)
+            elif kind == "send" and space_id in writer.spaces:
+                throttled = 0 if await relay_frame(websocket, space_id, current_user, control.get("data", "")) else throttled + 1
+                if WS_THROTTLE_CLOSE_AFTER and throttled >= WS_THROTTLE_CLOSE_AFTER:
+                    manager.drop(websocket, close_code=status.WS_1008_POLICY_VIOLATION)
+                    break
+            else:
+                manager.send(websocket, json.dumps({"type": "error", "space_id": space_id, "detail": "Unsupported control frame"}))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        manager.drop(websocket)
+
+def is_typing_frame(text: str) -> bool:
+    if not text.startswith("{") or '"typing"' not in text:
+        return False
+    try:
+        frame = json.loads(text)
+    except ValueError:
+        return False
+    return isinstance(frame, dict) and frame.get("type") == "typing"
+
+async def relay_frame(websocket: WebSocket, space_id: int, current_user, data: str) -> bool:
+    # Returns False when the frame was dropped by the rate limiter; the client
+    # gets a throttle frame telling it how long to back off
+    wait = rate_limit.message_limiter.check(current_user.id, space_id)
+    if wait:
+        websocket_manager.manager.send(websocket, json.dumps({"type": "throttled", "space_id": space_id, "retry_after": round(wait, 3)}))
+        return False
+    if websocket_manager.is_server_frame(data):
+        websocket_manager.manager.send(websocket, json.dumps({"type": "error", "space_id": space_id, "detail": "Frames may not impersonate server frames"}))
+        return True
+    # Messages are already encrypted on the client-side
+    # The backend just broadcasts them (and optionally stores them)
+    if WS_PERSIST_FRAMES:
+        message_row = await ingest.message_ingestor.submit(space_id=space_id, sender_id=current_user.id, content=data)
+        data = schemas.Message(**message_row, sender_display_name=current_user.display_name).json()
+    await websocket_manager.manager.broadcast(data, space_id)
+    return True
+
+async def send_catchup(websocket: WebSocket, space_id: int, last_message_id: Optional[int]):
+    # Replay buffer couldn't cover the gap: page missed messages from the
+    # database. Called right after subscribing, with no await in between, so
+    # live frames are held back from the start and land after the missed ones.
+    websocket_manager.manager.hold_live(websocket)
+    try:
+        await _send_missed(websocket, space_id, last_message_id)
+    finally:
+        websocket_manager.manager.release_live(websocket)
+
+async def _send_missed(websocket: WebSocket, space_id: int, last_message_id: Optional[int]):
+    resync = json.dumps({"type": "resync", "space_id": space_id})
+    if last_message_id is None:
+        websocket_manager.manager.send(websocket, resync)
+        return
+    if ingest.message_ingestor.has_pending(space_id):
+        await ingest.message_ingestor.flush()
+    sent = 0
+    async with database.ReadSessionLocal() as db:
+        if await crud_async.get_message_timestamp(db, space_id, last_message_id) is None:
+            # Unknown (or since purged) cursor: we can't tell what was missed
+            websocket_manager.manager.send(websocket, resync)
+            return
+        cursor = last_message_id
+        while sent < WS_CATCHUP_MAX_MESSAGES:
+            limit = min(crud.MESSAGE_PAGE_MAX, WS_CATCHUP_MAX_MESSAGES - sent)
+            rows = await crud_async.get_messages_for_space(db, space_id, after_id=cursor, limit=limit)
+            if rows is None:
+                # Cursor purged mid catch-up
+                break
+            for row in rows:
+                websocket_manager.manager.send(websocket, serializers.encode_message_row(row), space_id)
+            sent += len(rows)
+            if len(rows) < limit:
+                return
+            cursor = rows[-1][0]
+    websocket_manager.manager.send(websocket, resync)
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from typing import Set, Tuple
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import models
+import os
+import time
+
+# In-memory index of who belongs to which space, so membership checks on the
+# message hot path are a set lookup. A space's member set is loaded on first use
+# and kept current by crud_async.create_space / add_user_to_space. A user missing from
+# the set gets one indexed point query before being refused, which covers
+# members added through another worker. A refusal is then remembered for
+# MEMBERSHIP_NEGATIVE_TTL seconds, so a non-member retrying in a loop doesn't
+# cost a query each time; that is also how long a member added on another
+# worker may still be refused here.
+
+MEMBERSHIP_CACHE_SPACES = int(os.getenv("MEMBERSHIP_CACHE_SPACES", "10000"))
+MEMBERSHIP_NEGATIVE_TTL = float(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "5"))
+MEMBERSHIP_NEGATIVE_MAX = int(os.getenv("MEMBERSHIP_NEGATIVE_MAX", "100000"))
+
+
+class MembershipIndex:
+    def __init__(self, max_spaces: int = MEMBERSHIP_CACHE_SPACES, negative_ttl: float = MEMBERSHIP_NEGATIVE_TTL,
+                 max_negative: int = MEMBERSHIP_NEGATIVE_MAX):
+        self.max_spaces = max_spaces
+        self.spaces: "OrderedDict[int, Set[int]]" = OrderedDict()
+        self.negative_ttl = negative_ttl
+        self.max_negative = max_negative
+        # (space_id, user_id) -> monotonic expiry, oldest first
+        self.refused: "OrderedDict[Tuple[int, int], float]" = OrderedDict()
+
+    async def _load(self, db: AsyncSession, space_id: int) -> Set[int]:
+        result = await db.execute(
+            select(models.SpaceMember.user_id).where(models.SpaceMember.space_id == space_id)
+        )
+        members = set(result.scalars())
+        # Keep anything added while the query was running
+        members |= self.spaces.get(space_id, set())
+        self.spaces[space_id] = members
+        while len(self.spaces) > self.max_spaces:
+            self.spaces.popitem(last=False)
+        return members
+
+    async def is_member(self, db: AsyncSession, space_id: int, user_id: int) -> bool:
+        members = self.spaces.get(space_id)
+        if members is None:
+            members = await self._load(db, space_id)
+        else:
+            self.spaces.move_to_end(space_id)
+        if user_id in members:
+            return True
+        key = (space_id, user_id)
+        expires = self.refused.get(key)
+        if expires is not None:
+            if expires > time.monotonic():
+                return False
+            del self.refused[key]
+
+        found = (await db.execute(
+            select(models.SpaceMember.id).where(
+                models.SpaceMember.space_id == space_id,
+                models.SpaceMember.user_id == user_id
+            )
+        )).first()
+        if found is None:
+            self._refuse(key)
+            return False
+        members.add(user_id)
+        return True
+
+    def _refuse(self, key: Tuple[int, int]):
+        if self.negative_ttl <= 0:
+            return
+        self.refused[key] = time.monotonic() + self.negative_ttl
+        self.refused.move_to_end(key)
+        while len(self.refused) > self.max_negative:
+            self.refused.popitem(last=False)
+
+    def add(self, space_id: int, user_id: int):
+        self.refused.pop((space_id, user_id), None)
+        members = self.spaces.get(space_id)
+        if members is not None:
+            members.add(user_id)
+
+membership_index = MembershipIndex()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Index, text
 from sqlalchemy.orm import relationship
 from .database import Base
 import datetime
@@ -32,19 +32,44 @@ class SpaceMember(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     space_id = Column(Integer, ForeignKey("spaces.id"))
     encrypted_space_key = Column(String)
+    last_read_at = Column(DateTime, nullable=True)
 
     user = relationship("User", back_populates="spaces")
     space = relationship("Space", back_populates="members")
 
+    # Backs membership lookups and rejects duplicate memberships
+    __table_args__ = (
+        Index("ux_space_members_space_user", "space_id", "user_id", unique=True),
+    )
+
 class Message(Base):
     __tablename__ = "messages"
 
     id = Column(Integer, primary_key=True, index=True)
     space_id = Column(Integer, ForeignKey("spaces.id"))
     sender_id = Column(Integer, ForeignKey("users.id"))
+    # NULL once the message is deleted; the row stays behind as a tombstone
     content = Column(String)
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
     is_deleted = Column(Integer, default=0)
 
     space = relationship("Space", back_populates="messages")
     sender = relationship("User")
+
+    # Backs keyset pagination of a space's history (newest page first). The
+    # partial indexes cover live-only history pages and tombstone compaction,
+    # so neither has to scan past the other kind of row.
+    __table_args__ = (
+        Index("ix_messages_space_timestamp_id", "space_id", "timestamp", "id"),
+        Index("ix_messages_live_space_timestamp_id", "space_id", "timestamp", "id",
+              sqlite_where=text("is_deleted = 0"), postgresql_where=text("is_deleted = 0")),
+        Index("ix_messages_tombstones_timestamp", "timestamp",
+              sqlite_where=text("is_deleted = 1"), postgresql_where=text("is_deleted = 1")),
+    )
+
+class IdSequence(Base):
+    # Hands out blocks of ids to writers that assign ids before inserting
+    __tablename__ = "id_sequences"
+
+    name = Column(String, primary_key=True)
+    next_value = Column(Integer, nullable=False)
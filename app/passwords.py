@@ -0,0 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from fastapi import HTTPException, status
+from . import metrics
+import asyncio
+import bcrypt
+import os
+
+# bcrypt hashing and verification, run off the event loop on a small dedicated
+# thread pool (bcrypt releases the GIL, so threads give real parallelism).
+# Admission is capped: once PASSWORD_QUEUE_LIMIT operations are queued or
+# running, new ones are rejected immediately with 429 instead of piling up.
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", "64"))
+
+
+def _password_bytes(password: str) -> bytes:
+    # bcrypt only looks at the first 72 bytes
+    return password.encode('utf-8')[:72]
+
+def hash_password_sync(password: str) -> str:
+    return bcrypt.hashpw(_password_bytes(password), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
+
+def verify_password_sync(plain_password: str, hashed_password: str) -> bool:
+    return bcrypt.checkpw(_password_bytes(plain_password), hashed_password.encode('utf-8'))
+
+
+class PasswordPool:
+    def __init__(self, workers: int = PASSWORD_WORKERS, queue_limit: int = PASSWORD_QUEUE_LIMIT):
+        self.workers = workers
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.queue_limit = queue_limit
+        self.in_flight = 0
+        self.rejected = 0
+
+    async def start(self):
+        # The executor lives from start() to stop(), so the app can be started
+        # again in the same process (tests, embedded servers)
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+
+    async def stop(self):
+        executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    async def _run(self, fn, *args):
+        if self.in_flight >= self.queue_limit:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many authentication requests, try again shortly",
+                headers={"Retry-After": "1"},
+            )
+        # Also serves callers that never ran the app's startup
+        await self.start()
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.in_flight -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password_sync, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password_sync, plain_password, hashed_password)
+
+password_pool = PasswordPool()
+
+metrics.CallbackGauge(
+    "bcrypt_in_flight", "bcrypt operations queued or running",
+    lambda: [((), password_pool.in_flight)])
+metrics.CallbackGauge(
+    "bcrypt_rejected_total", "bcrypt operations rejected with 429",
+    lambda: [((), password_pool.rejected)], kind="counter")
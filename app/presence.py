@@ -0,0 +1,126 @@
+from typing import Dict, Set
+from .websocket_manager import ConnectionManager, manager
+from . import metrics
+import asyncio
+import json
+import os
+import time
+
+# Online and typing state per space, fed by the ConnectionManager as sockets
+# join and leave spaces. Changes are collected and pushed to each space as one
+# {"type": "presence", "space_id", "online", "offline", "typing", "idle"} delta
+# per PRESENCE_INTERVAL_MS, however many sockets or keystrokes caused them.
+# Sockets get a full snapshot ("snapshot": true) when they join a space.
+#
+# State is per worker process: with several workers the deltas reach everyone
+# through the backplane, but snapshots only list users connected locally.
+
+PRESENCE_INTERVAL_MS = int(os.getenv("PRESENCE_INTERVAL_MS", "250"))
+# A typing indicator lapses unless it is refreshed within this many seconds
+PRESENCE_TYPING_TTL = float(os.getenv("PRESENCE_TYPING_TTL", "5"))
+
+_DELTA_KEYS = ("online", "offline", "typing", "idle")
+
+
+def presence_frame(space_id: int, **fields) -> str:
+    return json.dumps({"type": "presence", "space_id": space_id, **fields})
+
+
+class PresenceService:
+    def __init__(self, manager: ConnectionManager, interval: float = PRESENCE_INTERVAL_MS / 1000, typing_ttl: float = PRESENCE_TYPING_TTL):
+        self.manager = manager
+        self.interval = interval
+        self.typing_ttl = typing_ttl
+        # space_id -> user_id -> local sockets in that space
+        self.online: Dict[int, Dict[int, int]] = {}
+        # space_id -> user_id -> typing expiry (monotonic)
+        self.typing: Dict[int, Dict[int, float]] = {}
+        # space_id -> {"online": set(), "offline": set(), ...} since the last push
+        self.pending: Dict[int, Dict[str, Set[int]]] = {}
+        self.task = None
+        manager.presence = self
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def _mark(self, space_id: int, key: str, opposite: str, user_id: int):
+        delta = self.pending.get(space_id)
+        if delta is None:
+            delta = self.pending[space_id] = {name: set() for name in _DELTA_KEYS}
+        delta[opposite].discard(user_id)
+        delta[key].add(user_id)
+
+    def joined(self, space_id: int, user_id: int):
+        users = self.online.setdefault(space_id, {})
+        users[user_id] = users.get(user_id, 0) + 1
+        if users[user_id] == 1:
+            self._mark(space_id, "online", "offline", user_id)
+
+    def left(self, space_id: int, user_id: int):
+        users = self.online.get(space_id)
+        if not users or user_id not in users:
+            return
+        users[user_id] -= 1
+        if users[user_id]:
+            return
+        del users[user_id]
+        if not users:
+            del self.online[space_id]
+        self._stop_typing(space_id, user_id)
+        self._mark(space_id, "offline", "online", user_id)
+
+    def set_typing(self, space_id: int, user_id: int):
+        typing = self.typing.setdefault(space_id, {})
+        if user_id not in typing:
+            self._mark(space_id, "typing", "idle", user_id)
+        typing[user_id] = time.monotonic() + self.typing_ttl
+
+    def _stop_typing(self, space_id: int, user_id: int):
+        typing = self.typing.get(space_id)
+        if typing is None or typing.pop(user_id, None) is None:
+            return
+        if not typing:
+            del self.typing[space_id]
+        self._mark(space_id, "idle", "typing", user_id)
+
+    def snapshot(self, space_id: int) -> str:
+        return presence_frame(
+            space_id,
+            snapshot=True,
+            online=list(self.online.get(space_id, ())),
+            typing=list(self.typing.get(space_id, ())),
+        )
+
+    def flush(self):
+        now = time.monotonic()
+        for space_id, typing in list(self.typing.items()):
+            for user_id, expires_at in list(typing.items()):
+                if expires_at <= now:
+                    self._stop_typing(space_id, user_id)
+
+        pending, self.pending = self.pending, {}
+        for space_id, delta in pending.items():
+            fields = {key: list(users) for key, users in delta.items() if users}
+            if fields:
+                self.manager.publish_presence(space_id, presence_frame(space_id, **fields))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+presence = PresenceService(manager)
+
+metrics.CallbackGauge(
+    "presence_online_users", "Users online in at least one space on this worker",
+    lambda: [((), len({user_id for users in list(presence.online.values()) for user_id in users}))])
@@ -0,0 +1,61 @@
+from fastapi import HTTPException, status
+from .utils.token_bucket import TokenBuckets
+from . import metrics
+import math
+import os
+import time
+
+# Message ingress limits, checked for every POST /messages/ and every frame a
+# client sends over a WebSocket. A message needs a token from both its sender's
+# bucket and its space's bucket; a rate of 0 turns that limit off.
+
+RATE_LIMIT_USER_RATE = float(os.getenv("RATE_LIMIT_USER_RATE", "5"))
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "20"))
+RATE_LIMIT_SPACE_RATE = float(os.getenv("RATE_LIMIT_SPACE_RATE", "50"))
+RATE_LIMIT_SPACE_BURST = float(os.getenv("RATE_LIMIT_SPACE_BURST", "200"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+rate_limited = metrics.Counter("rate_limited_total", "Messages rejected by the ingress rate limiter", ("scope",))
+
+
+class MessageRateLimiter:
+    def __init__(self, user_rate: float = RATE_LIMIT_USER_RATE, user_burst: float = RATE_LIMIT_USER_BURST,
+                 space_rate: float = RATE_LIMIT_SPACE_RATE, space_burst: float = RATE_LIMIT_SPACE_BURST,
+                 max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.users = TokenBuckets(user_rate, user_burst, max_keys) if user_rate > 0 else None
+        self.spaces = TokenBuckets(space_rate, space_burst, max_keys) if space_rate > 0 else None
+
+    def check(self, user_id: int, space_id: int) -> float:
+        # Takes a token from both buckets and returns 0, or returns the seconds
+        # to wait without taking anything
+        now = time.monotonic()
+        if self.users is not None:
+            wait = self.users.wait_time(user_id, now)
+            if wait:
+                rate_limited.inc("user")
+                return wait
+        if self.spaces is not None:
+            wait = self.spaces.wait_time(space_id, now)
+            if wait:
+                rate_limited.inc("space")
+                return wait
+            self.spaces.take(space_id)
+        if self.users is not None:
+            self.users.take(user_id)
+        return 0.0
+
+    def enforce(self, user_id: int, space_id: int):
+        wait = self.check(user_id, space_id)
+        if wait:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many messages, slow down",
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
+
+message_limiter = MessageRateLimiter()
+
+metrics.CallbackGauge(
+    "rate_limit_buckets", "Token buckets held by the ingress rate limiter",
+    lambda: [((scope,), len(buckets)) for scope, buckets in (("user", message_limiter.users), ("space", message_limiter.spaces)) if buckets is not None],
+    labelnames=("scope",))
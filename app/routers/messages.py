@@ -1,65 +1,76 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
-from .. import crud, schemas, auth, database, websocket_manager, models
-import json
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from .. import crud, crud_async, schemas, auth, database, websocket_manager, models, ingest, serializers, rate_limit, space_view
+from ..log import get_logger
 
 router = APIRouter()
+logger = get_logger(__name__)
 
 @router.post("/messages/", response_model=schemas.Message)
 async def create_message(
     message: schemas.MessageCreate,
     space_id: int,
-    db: Session = Depends(database.get_db),
-    current_user: schemas.User = Depends(auth.get_current_user)
+    current_user: schemas.User = Depends(auth.require_space_member)
 ):
-    print(f"[DEBUG] Received message for space {space_id} from user {current_user.id}")
-    print(f"[DEBUG] Message content (encrypted): {message.content}")
-    # TODO: Check if current_user is a member of the space
-    db_message = crud.create_message(db=db, space_id=space_id, sender_id=current_user.id, content=message.content)
-    
-    # Fetch sender's display name for broadcasting
-    sender = db.query(models.User).filter(models.User.id == db_message.sender_id).first()
-    sender_display_name = sender.display_name if sender else "Unknown User"
-
-    # Convert SQLAlchemy model to Pydantic schema and add sender_display_name
-    message_data = schemas.Message.from_orm(db_message)
-    message_data.sender_display_name = sender_display_name
-
-    print(f"[DEBUG] Message data before JSON dump: {message_data.dict()}")
+    rate_limit.message_limiter.enforce(current_user.id, space_id)
+    # Id and timestamp are assigned up front; the row is persisted in the next group commit
+    message_row = await ingest.message_ingestor.submit(space_id=space_id, sender_id=current_user.id, content=message.content)
+    message_data = schemas.Message(**message_row, sender_display_name=current_user.display_name)
+    logger.debug("message accepted", space_id=space_id, sender_id=current_user.id, message_id=message_data.id)
     # Use Pydantic's .json() method for proper datetime serialization
     await websocket_manager.manager.broadcast(message_data.json(), space_id)
-    return db_message
+    return message_data
 
 @router.get("/messages/{space_id}", response_model=List[schemas.Message])
-def get_messages(
+async def get_messages(
     space_id: int,
-    db: Session = Depends(database.get_db),
-    current_user: schemas.User = Depends(auth.get_current_user)
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(crud.MESSAGE_PAGE_DEFAULT, ge=1, le=crud.MESSAGE_PAGE_MAX),
+    include_deleted: bool = True,
+    db: AsyncSession = Depends(database.get_read_db),
+    current_user: schemas.User = Depends(auth.require_space_member)
 ):
-    # TODO: Check if current_user is a member of the space
-    messages_with_sender_info = crud.get_messages_for_space(db=db, space_id=space_id)
-    return [schemas.Message(**msg) for msg in messages_with_sender_info]
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Use either before_id or after_id, not both")
+    if ingest.message_ingestor.has_pending(space_id):
+        # Read-your-writes: land this space's queued messages before paging
+        await ingest.message_ingestor.flush()
+    rows = await crud_async.get_messages_for_space(db=db, space_id=space_id, before_id=before_id, after_id=after_id, limit=limit, include_deleted=include_deleted)
+    if rows is None:
+        # The cursor message was purged (or never existed): the client has to
+        # resync from the newest page rather than page on from it
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Cursor message no longer exists; reload the newest page")
+    return StreamingResponse(serializers.stream_message_rows(rows), media_type="application/json")
 
 @router.delete("/messages/{message_id}", response_model=schemas.Message)
 async def delete_message(
     message_id: int,
-    db: Session = Depends(database.get_db),
+    db: AsyncSession = Depends(database.get_async_db),
     current_user: schemas.User = Depends(auth.get_current_user)
 ):
-    db_message = db.query(models.Message).filter(models.Message.id == message_id).first()
+    # The message may still be waiting in the write-behind queue
+    await ingest.message_ingestor.flush()
+    db_message = await crud_async.get_message(db, message_id)
     if not db_message:
-        raise HTTPException(status_code=404, detail="Message not found")
+        archived = await crud_async.find_archived_message(db, current_user.id, message_id)
+        if archived is None:
+            raise HTTPException(status_code=404, detail="Message not found")
+        if archived[2] != current_user.id:
+            raise HTTPException(status_code=403, detail="Not authorized to delete this message")
+        # The archive is append-only; its rows can't be turned into tombstones
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Message has been archived and can no longer be deleted")
     
     # Check if current_user is the sender of the message
     if db_message.sender_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not authorized to delete this message")
 
-    deleted_message = crud.delete_message(db=db, message_id=message_id)
-    # Broadcast the deleted message status
+    deleted_message = await crud_async.delete_message(db=db, message_id=message_id)
+    space_view.my_spaces.on_message_deleted(deleted_message.space_id, message_id)
+    # Broadcast the deleted message status; the sender is the current user
     deleted_message_data = schemas.Message.from_orm(deleted_message)
-    # Ensure sender_display_name is included for broadcast if needed by frontend
-    sender = db.query(models.User).filter(models.User.id == deleted_message.sender_id).first()
-    deleted_message_data.sender_display_name = sender.display_name if sender else "Unknown User"
+    deleted_message_data.sender_display_name = current_user.display_name
     await websocket_manager.manager.broadcast(deleted_message_data.json(), deleted_message.space_id)
-    return deleted_message
+    return deleted_message_data
@@ -1,51 +1,187 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
-from .. import crud, schemas, auth, database, models
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from .. import crud_async, schemas, auth, database, models, ingest, membership, serializers, space_view
+import json
+import os
 
 router = APIRouter()
 
+# Most members one bulk request may add
+BULK_MEMBERS_MAX = int(os.getenv("BULK_MEMBERS_MAX", "10000"))
+
 @router.post("/spaces/", response_model=schemas.Space)
-def create_space(
+async def create_space(
     space: schemas.SpaceCreate,
     encrypted_space_key: str, # New parameter for the creator's encrypted key
-    db: Session = Depends(database.get_db),
+    db: AsyncSession = Depends(database.get_async_db),
     current_user: schemas.User = Depends(auth.get_current_user)
 ):
-    return crud.create_space(db=db, space=space, user_id=current_user.id, encrypted_space_key=encrypted_space_key)
+    db_space = await crud_async.create_space(db=db, space=space, user_id=current_user.id, encrypted_space_key=encrypted_space_key)
+    space_view.my_spaces.on_space_created(db_space, encrypted_space_key, current_user.display_name)
+    return db_space
 
-@router.get("/spaces/me", response_model=List[schemas.SpaceWithMemberInfo])
-def read_my_spaces(db: Session = Depends(database.get_db), current_user: schemas.User = Depends(auth.get_current_user)):
-    return crud.get_spaces_for_user(db=db, user_id=current_user.id)
+@router.get("/spaces/me", response_model=List[schemas.SpaceSummary])
+async def read_my_spaces(db: AsyncSession = Depends(database.get_read_db), current_user: schemas.User = Depends(auth.get_current_user)):
+    spaces = await space_view.my_spaces.get(db, current_user.id)
+    return Response(serializers.space_summary_serializer.dumps_mappings(spaces), media_type="application/json")
+
+@router.post("/spaces/{space_id}/read")
+async def mark_space_read(
+    space_id: int,
+    message_id: Optional[int] = None,
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: schemas.User = Depends(auth.require_space_member)
+):
+    if message_id is not None and ingest.message_ingestor.has_pending(space_id):
+        await ingest.message_ingestor.flush()
+    read_at = await crud_async.mark_space_read(db, space_id=space_id, user_id=current_user.id, message_id=message_id)
+    if read_at is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    space_view.my_spaces.on_read(current_user.id, space_id, message_id)
+    return {"space_id": space_id, "last_read_at": read_at}
 
 @router.post("/spaces/{space_id}/add_member")
-def add_member_to_space(
+async def add_member_to_space(
     space_id: int,
     member_data: schemas.SpaceMemberCreate,
-    db: Session = Depends(database.get_db),
+    db: AsyncSession = Depends(database.get_async_db),
     current_user: schemas.User = Depends(auth.get_current_user)
 ):
-    space = db.query(models.Space).filter(models.Space.id == space_id).first()
+    space = await db.get(models.Space, space_id)
     if not space:
         raise HTTPException(status_code=404, detail="Space not found")
     if space.created_by != current_user.id:
         raise HTTPException(status_code=403, detail="Only space creator can add members")
 
-    user_to_add = crud.get_user_by_username(db, username=member_data.username)
+    user_to_add = await crud_async.get_user_by_username(db, username=member_data.username)
     if not user_to_add:
         raise HTTPException(status_code=404, detail="User not found")
+    if await crud_async.get_member_ids(db, space_id, [user_to_add.id]):
+        raise HTTPException(status_code=400, detail="User is already a member of this space")
 
-    crud.add_user_to_space(db=db, space_id=space_id, user_id=user_to_add.id, encrypted_space_key=member_data.encrypted_space_key)
+    try:
+        await crud_async.add_user_to_space(db=db, space_id=space_id, user_id=user_to_add.id, encrypted_space_key=member_data.encrypted_space_key)
+    except IntegrityError:
+        # A concurrent request added them between the check and the insert
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="User is already a member of this space")
+    space_view.my_spaces.on_member_added(user_to_add.id, space, member_data.encrypted_space_key, current_user.display_name)
     return {"message": f"User {member_data.username} added to space {space.name}"}
 
+@router.post("/spaces/{space_id}/members/bulk", response_model=schemas.SpaceMembersBulkResult)
+async def add_members_to_space(
+    space_id: int,
+    bulk: schemas.SpaceMembersBulkCreate,
+    stream: bool = False,
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: schemas.User = Depends(auth.get_current_user)
+):
+    # Adds many members in one transaction. With stream=true the response is
+    # NDJSON: a {"type": "progress"} line per chunk, then one {"type": "result"}
+    # line per member and a final {"type": "done"}. Streamed adds commit each
+    # chunk before reporting it, so a slow reader never holds the write
+    # transaction; after an error, retrying is safe (added members come back
+    # as "already_member").
+    if len(bulk.members) > BULK_MEMBERS_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MEMBERS_MAX} members per request")
+    space = await db.get(models.Space, space_id)
+    if not space:
+        raise HTTPException(status_code=404, detail="Space not found")
+    if space.created_by != current_user.id:
+        raise HTTPException(status_code=403, detail="Only space creator can add members")
+
+    if stream:
+        # Hand the connection back first: the body opens its own session, and
+        # on SQLite there is only one writer connection
+        await db.commit()
+        return StreamingResponse(_stream_bulk_add(space, bulk.members, current_user.display_name), media_type="application/x-ndjson")
+    try:
+        async for event in _bulk_add(db, space, bulk.members, current_user.display_name):
+            if event["type"] == "done":
+                return {"added": event["added"], "results": event["results"]}
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="Membership changed while adding members, try again")
+
+async def _stream_bulk_add(space: models.Space, members: list, creator_display_name: str):
+    # Own session: the request's one may be closed before the body is sent
+    async with database.AsyncSessionLocal() as db:
+        try:
+            async for event in _bulk_add(db, space, members, creator_display_name, commit_chunks=True):
+                if event["type"] == "done":
+                    for result in event.pop("results"):
+                        yield json.dumps({"type": "result", **result}) + "\n"
+                yield json.dumps(event) + "\n"
+        except IntegrityError:
+            yield json.dumps({"type": "error", "detail": "Membership changed while adding members, try again"}) + "\n"
+
+async def _bulk_add(db: AsyncSession, space: models.Space, members: list, creator_display_name: str, commit_chunks: bool = False):
+    # One user lookup, one membership check and one multi-row insert per chunk,
+    # and a single commit at the end unless commit_chunks. Progress events are
+    # only yielded with no transaction open.
+    statuses = [None] * len(members)
+    first_index = {}
+    for index, member in enumerate(members):
+        if member.username in first_index:
+            statuses[index] = "duplicate"
+        else:
+            first_index[member.username] = index
+    unique = list(first_index.items())
+
+    added = []
+    for start in range(0, len(unique), crud_async.BULK_CHUNK_SIZE):
+        chunk = unique[start:start + crud_async.BULK_CHUNK_SIZE]
+        user_ids = await crud_async.get_user_ids_by_username(db, [username for username, _ in chunk])
+        existing = await crud_async.get_member_ids(db, space.id, list(user_ids.values()))
+        new_members = []
+        for username, index in chunk:
+            user_id = user_ids.get(username)
+            if user_id is None:
+                statuses[index] = "not_found"
+            elif user_id in existing:
+                statuses[index] = "already_member"
+            else:
+                statuses[index] = "added"
+                new_members.append((user_id, members[index].encrypted_space_key))
+        if new_members:
+            try:
+                await crud_async.insert_space_members(db, space.id, new_members)
+                if commit_chunks:
+                    await db.commit()
+            except IntegrityError:
+                await db.rollback()
+                raise
+            if commit_chunks:
+                _members_added(space, new_members, creator_display_name)
+            added.extend(new_members)
+        elif commit_chunks:
+            # End the read transaction before waiting on the client
+            await db.commit()
+        if commit_chunks:
+            yield {"type": "progress", "processed": start + len(chunk), "total": len(unique)}
+
+    if not commit_chunks:
+        await db.commit()
+        _members_added(space, added, creator_display_name)
+    yield {
+        "type": "done",
+        "added": len(added),
+        "results": [{"username": member.username, "status": statuses[index]} for index, member in enumerate(members)],
+    }
+
+def _members_added(space: models.Space, members: list, creator_display_name: str):
+    # After commit: keep the membership index and cached space lists current
+    for user_id, encrypted_space_key in members:
+        membership.membership_index.add(space.id, user_id)
+        space_view.my_spaces.on_member_added(user_id, space, encrypted_space_key, creator_display_name)
+
 @router.get("/spaces/{space_id}/members", response_model=List[schemas.User])
-def get_space_members(space_id: int, db: Session = Depends(database.get_db), current_user: schemas.User = Depends(auth.get_current_user)):
-    # Add logic to check if current_user is a member of the space
-    is_member = db.query(models.SpaceMember).filter(
-        models.SpaceMember.space_id == space_id,
-        models.SpaceMember.user_id == current_user.id
-    ).first()
-    if not is_member:
-        raise HTTPException(status_code=403, detail="Not a member of this space")
-
-    return crud.get_space_members(db=db, space_id=space_id)
+async def get_space_members(
+    space_id: int,
+    db: AsyncSession = Depends(database.get_read_db),
+    current_user: schemas.User = Depends(auth.require_space_member)
+):
+    rows = await crud_async.get_space_member_rows(db=db, space_id=space_id)
+    return Response(serializers.user_serializer.dumps(rows), media_type="application/json")
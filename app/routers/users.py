@@ -1,32 +1,45 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from .. import crud, schemas, auth, database, models
-import bcrypt # Import bcrypt
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List
+from .. import crud_async, schemas, auth, database, models, passwords, user_cache
+from ..log import get_logger
+import hashlib
+import json
+import os
 
 router = APIRouter()
+logger = get_logger(__name__)
+
+# Public key responses carry a strong ETag and may be cached by clients for
+# this long before they revalidate (and usually get a 304)
+PUBLIC_KEY_MAX_AGE = int(os.getenv("PUBLIC_KEY_MAX_AGE", "60"))
+# Most usernames per batch lookup
+PUBLIC_KEYS_MAX = int(os.getenv("PUBLIC_KEYS_MAX", "500"))
 
 @router.post("/users/register", response_model=schemas.User)
-def register_user(user: schemas.UserCreate, db: Session = Depends(database.get_db)):
-    db_user = crud.get_user_by_username(db, username=user.username)
+async def register_user(user: schemas.UserCreate, db: AsyncSession = Depends(database.get_read_db)):
+    db_user = await crud_async.get_user_by_username(db, username=user.username)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
-    return crud.create_user(db=db, user=user)
+    hashed_password = await passwords.password_pool.hash(user.password)
+    # Only take the writer once the slow hash is done
+    async with database.AsyncSessionLocal() as write_db:
+        return await crud_async.create_user(db=write_db, user=user, hashed_password=hashed_password)
 
 @router.post("/users/token", response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(database.get_db)):
-    print(f"[DEBUG] Login attempt for username: {form_data.username}")
-    print(f"[DEBUG] Login password (from form): {form_data.password}")
-    user = crud.get_user_by_username(db, username=form_data.username)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(database.get_read_db)):
+    logger.debug("login attempt", username=form_data.username)
+    user = await crud_async.get_user_by_username(db, username=form_data.username)
     if not user:
-        print(f"[DEBUG] User {form_data.username} not found.")
+        logger.debug("login failed: unknown user", username=form_data.username)
         raise HTTPException(
             status_code=401,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    if not auth.verify_password(form_data.password, user.hashed_password):
-        print(f"[DEBUG] Password mismatch for user {form_data.username}.")
+    if not await auth.verify_password(form_data.password, user.hashed_password):
+        logger.debug("login failed: password mismatch", username=form_data.username)
         raise HTTPException(
             status_code=401,
             detail="Incorrect username or password",
@@ -39,27 +52,69 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 async def read_users_me(current_user: schemas.User = Depends(auth.get_current_user)):
     return current_user
 
+def _conditional_json(request: Request, payload) -> Response:
+    # Strong ETag over the exact body bytes; 304 when the client already has them
+    body = json.dumps(payload, separators=(",", ":")).encode()
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={PUBLIC_KEY_MAX_AGE}"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in (tag.strip() for tag in if_none_match.split(","))):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def _public_profiles(db: AsyncSession, usernames: list) -> dict:
+    # Served from user_cache.public_key_cache; misses are loaded in one IN query
+    profiles = {}
+    misses = []
+    for username in usernames:
+        profile = user_cache.public_key_cache.get(username)
+        if profile is None:
+            misses.append(username)
+        else:
+            profiles[username] = profile
+    if misses:
+        for user in await crud_async.get_users_by_usernames(db, misses):
+            profile = profiles[user.username] = user_cache.public_profile(user)
+            user_cache.public_key_cache.set(user.username, profile)
+    return profiles
+
+@router.get("/users/public_keys", response_model=schemas.PublicKeys)
+async def get_public_keys(
+    request: Request,
+    usernames: List[str] = Query(...),
+    db: AsyncSession = Depends(database.get_read_db)
+):
+    # ?usernames=a&usernames=b...; results are sorted by username so the same
+    # set always produces the same body (and ETag)
+    usernames = sorted(set(usernames))
+    if len(usernames) > PUBLIC_KEYS_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {PUBLIC_KEYS_MAX} usernames per request")
+    profiles = await _public_profiles(db, usernames)
+    return _conditional_json(request, {
+        "users": [profiles[username] for username in usernames if username in profiles],
+        "missing": [username for username in usernames if username not in profiles],
+    })
+
 @router.get("/users/{username}/public_key", response_model=schemas.User)
-def get_user_public_key(username: str, db: Session = Depends(database.get_db)):
-    user = crud.get_user_by_username(db, username=username)
-    if not user:
+async def get_user_public_key(username: str, request: Request, db: AsyncSession = Depends(database.get_read_db)):
+    profile = (await _public_profiles(db, [username])).get(username)
+    if profile is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return user
+    return _conditional_json(request, profile)
 
 @router.put("/users/me/password", response_model=schemas.User)
 async def change_password(
     password_change: schemas.UserPasswordChange,
-    db: Session = Depends(database.get_db),
+    db: AsyncSession = Depends(database.get_async_db),
     current_user: schemas.User = Depends(auth.get_current_user)
 ):
     # Verify current password
-    if not auth.verify_password(password_change.current_password, current_user.hashed_password):
+    if not await auth.verify_password(password_change.current_password, current_user.hashed_password):
         raise HTTPException(status_code=400, detail="Incorrect current password")
     
     # Hash new password
-    new_hashed_password_bytes = bcrypt.hashpw(password_change.new_password.encode('utf-8')[:72], bcrypt.gensalt())
-    new_hashed_password_str = new_hashed_password_bytes.decode('utf-8')
+    new_hashed_password_str = await passwords.password_pool.hash(password_change.new_password)
 
     # Update password in DB
-    updated_user = crud.update_user_password(db, current_user.id, new_hashed_password_str)
+    updated_user = await crud_async.update_user_password(db, current_user.id, new_hashed_password_str)
     return updated_user
@@ -53,6 +53,11 @@ class SpaceWithMemberInfo(Space):
         orm_mode = True
         from_attributes = True
 
+class SpaceSummary(SpaceWithMemberInfo):
+    last_message_id: Optional[int] = None
+    last_message_at: Optional[datetime.datetime] = None
+    unread_count: int = 0
+
 class MessageBase(BaseModel):
     content: str
 
@@ -60,6 +65,7 @@ class MessageCreate(MessageBase):
     pass
 
 class Message(MessageBase):
+    content: Optional[str] = None # None for deleted messages
     id: int
     space_id: int
     sender_id: int
@@ -71,6 +77,10 @@ class Message(MessageBase):
         orm_mode = True # Keep for now, but Pydantic v2 prefers from_attributes
         from_attributes = True
 
+class PublicKeys(BaseModel):
+    users: List[User]
+    missing: List[str]
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -81,3 +91,14 @@ class TokenData(BaseModel):
 class SpaceMemberCreate(BaseModel):
     username: str
     encrypted_space_key: str
+
+class SpaceMembersBulkCreate(BaseModel):
+    members: List[SpaceMemberCreate]
+
+class SpaceMemberResult(BaseModel):
+    username: str
+    status: str # added, not_found, already_member or duplicate
+
+class SpaceMembersBulkResult(BaseModel):
+    added: int
+    results: List[SpaceMemberResult]
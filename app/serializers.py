@@ -0,0 +1,112 @@
+from operator import itemgetter
+from pydantic_core import to_json
+from typing import Iterable, Sequence
+import base64
+import binascii
+import json
+import msgpack
+import zlib
+
+# Wire encodings for list responses and WebSocket frames.
+#
+# List routes go straight from SQL row tuples (or cached dicts) to JSON through
+# a RowSerializer built once per response schema, instead of constructing and
+# validating a Pydantic model per row. The output matches what FastAPI would
+# produce from the route's response_model.
+#
+# On WebSockets, JSON is the default. Clients that negotiate "msgpack" get binary frames
+# instead: one flag byte (BINARY_PLAIN or BINARY_DEFLATE) followed by the
+# MessagePack array [space_id, seq, payload]. Message payloads are positional
+# arrays in MESSAGE_ROW_FIELDS order. Content stays a string unless the client
+# connected with binary_content=true, declaring its messages carry base64
+# ciphertext: then it's sent as the raw bytes. Relayed raw frames are never
+# touched.
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+ENCODINGS = (ENCODING_JSON, ENCODING_MSGPACK)
+
+BINARY_PLAIN = b"\x00"
+BINARY_DEFLATE = b"\x01"
+
+class RowSerializer:
+    # Encodes rows whose values are in `fields` order as JSON objects with
+    # those keys; mappings (e.g. cached dicts) go through encode_mapping
+    def __init__(self, fields: Sequence[str]):
+        self.fields = tuple(fields)
+        self._values = itemgetter(*self.fields)
+
+    def encode(self, row) -> str:
+        return to_json(dict(zip(self.fields, row))).decode()
+
+    def encode_mapping(self, mapping) -> str:
+        return self.encode(self._values(mapping))
+
+    def stream(self, rows: Iterable) -> Iterable[str]:
+        # One row at a time, so the full JSON list is never built in memory
+        yield "["
+        for index, row in enumerate(rows):
+            yield ("," if index else "") + self.encode(row)
+        yield "]"
+
+    def dumps(self, rows: Iterable) -> bytes:
+        # pydantic_core's encoder handles datetimes the same way the models do
+        fields = self.fields
+        return to_json([dict(zip(fields, row)) for row in rows])
+
+    def dumps_mappings(self, mappings: Iterable) -> bytes:
+        return self.dumps(map(self._values, mappings))
+
+
+# Field order follows the Pydantic schemas (base class fields first)
+MESSAGE_ROW_FIELDS = ("id", "space_id", "sender_id", "content", "timestamp", "is_deleted", "sender_display_name")
+USER_FIELDS = ("username", "display_name", "public_key", "avatar", "id")
+SPACE_SUMMARY_FIELDS = ("name", "id", "created_by", "encrypted_space_key", "creator_display_name", "last_message_id", "last_message_at", "unread_count")
+
+message_serializer = RowSerializer(MESSAGE_ROW_FIELDS)
+user_serializer = RowSerializer(USER_FIELDS)
+space_summary_serializer = RowSerializer(SPACE_SUMMARY_FIELDS)
+
+_MESSAGE_FIELD_SET = frozenset(MESSAGE_ROW_FIELDS)
+_CONTENT_INDEX = MESSAGE_ROW_FIELDS.index("content")
+
+def encode_message_row(row) -> str:
+    return message_serializer.encode(row)
+
+def stream_message_rows(rows):
+    return message_serializer.stream(rows)
+
+
+def compact_content(content):
+    # Only for content the client declared binary. Canonical base64 comes back
+    # as raw bytes, anything else is left alone
+    if not isinstance(content, str) or not content or len(content) % 4:
+        return content
+    try:
+        raw = base64.b64decode(content, validate=True)
+    except (binascii.Error, ValueError):
+        return content
+    return raw if base64.b64encode(raw).decode("ascii") == content else content
+
+def compact_payload(frame: str, binary_content: bool = False):
+    # Frames are built as JSON text; re-shape them for the binary encoding
+    if not frame.startswith("{"):
+        return frame
+    try:
+        value = json.loads(frame)
+    except ValueError:
+        return frame
+    if isinstance(value, dict) and value.keys() == _MESSAGE_FIELD_SET:
+        row = [value[field] for field in MESSAGE_ROW_FIELDS]
+        if binary_content:
+            row[_CONTENT_INDEX] = compact_content(row[_CONTENT_INDEX])
+        return row
+    return value
+
+def binary_frame(space_id: int, seq, frame: str, compress_threshold: int = 0, binary_content: bool = False) -> bytes:
+    body = msgpack.packb([space_id, seq, compact_payload(frame, binary_content)])
+    if compress_threshold and len(body) >= compress_threshold:
+        compressed = zlib.compress(body)
+        if len(compressed) < len(body):
+            return BINARY_DEFLATE + compressed
+    return BINARY_PLAIN + body
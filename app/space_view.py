@@ -0,0 +1,146 @@
+from typing import Dict, List, Set
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import models
+from .utils.cache import TTLCache
+import os
+
+# Precomputed "my spaces" sidebar per user: the space list plus the latest
+# message and unread count of each space. Loaded with one query on first use,
+# then kept current in place as messages arrive or are deleted, spaces are
+# created and members are added. Views are per process; SPACE_VIEW_TTL bounds how long changes made
+# through another worker can go unnoticed.
+
+SPACE_VIEW_USERS = int(os.getenv("SPACE_VIEW_USERS", "10000"))
+SPACE_VIEW_TTL = float(os.getenv("SPACE_VIEW_TTL", "30"))
+
+
+def _space_entry(space_id: int, name: str, created_by: int, encrypted_space_key: str, creator_display_name: str) -> dict:
+    return {
+        "id": space_id,
+        "name": name,
+        "created_by": created_by,
+        "encrypted_space_key": encrypted_space_key,
+        "creator_display_name": creator_display_name,
+        "last_message_id": None,
+        "last_message_at": None,
+        "unread_count": 0,
+    }
+
+
+class SpaceListView:
+    def __init__(self, max_users: int = SPACE_VIEW_USERS, ttl: float = SPACE_VIEW_TTL):
+        self.views = TTLCache(maxsize=max_users, ttl=ttl)
+        # space id -> users whose view contains it, for message updates
+        self.watchers: Dict[int, Set[int]] = {}
+
+    async def get(self, db: AsyncSession, user_id: int) -> List[dict]:
+        view = self.views.get(user_id)
+        if view is None:
+            view = await self._load(db, user_id)
+        return list(view.values())
+
+    async def _load(self, db: AsyncSession, user_id: int) -> Dict[int, dict]:
+        message = models.Message
+        member = models.SpaceMember
+        latest = select(message.id, message.timestamp) \
+            .where(message.space_id == models.Space.id, message.is_deleted == 0) \
+            .order_by(message.timestamp.desc(), message.id.desc()) \
+            .limit(1)
+        unread = select(func.count(message.id)) \
+            .where(
+                message.space_id == models.Space.id,
+                message.sender_id != user_id,
+                message.is_deleted == 0,
+                (member.last_read_at.is_(None)) | (message.timestamp > member.last_read_at)
+            ) \
+            .scalar_subquery()
+        result = await db.execute(
+            select(
+                models.Space.id,
+                models.Space.name,
+                models.Space.created_by,
+                member.encrypted_space_key,
+                models.User.display_name,
+                latest.with_only_columns(message.id).scalar_subquery(),
+                latest.with_only_columns(message.timestamp).scalar_subquery(),
+                unread
+            )
+            .join(member, models.Space.id == member.space_id)
+            .join(models.User, models.Space.created_by == models.User.id)
+            .where(member.user_id == user_id)
+        )
+
+        view = {}
+        for space_id, name, created_by, key, creator_name, last_id, last_at, unread_count in result.all():
+            entry = _space_entry(space_id, name, created_by, key, creator_name)
+            entry["last_message_id"] = last_id
+            entry["last_message_at"] = last_at
+            entry["unread_count"] = unread_count
+            view[space_id] = entry
+            self.watchers.setdefault(space_id, set()).add(user_id)
+        self.views.set(user_id, view)
+        return view
+
+    def _add_space(self, user_id: int, entry: dict):
+        view = self.views.peek(user_id)
+        if view is None:
+            # Not loaded; the next read builds it from the database
+            return
+        view[entry["id"]] = entry
+        self.watchers.setdefault(entry["id"], set()).add(user_id)
+
+    def on_space_created(self, space: models.Space, encrypted_space_key: str, creator_display_name: str):
+        self._add_space(space.created_by, _space_entry(space.id, space.name, space.created_by, encrypted_space_key, creator_display_name))
+
+    def on_member_added(self, user_id: int, space: models.Space, encrypted_space_key: str, creator_display_name: str):
+        self._add_space(user_id, _space_entry(space.id, space.name, space.created_by, encrypted_space_key, creator_display_name))
+
+    def on_message(self, message: dict):
+        watchers = self.watchers.get(message["space_id"])
+        if not watchers:
+            return
+        for user_id in list(watchers):
+            view = self.views.peek(user_id)
+            if view is None or message["space_id"] not in view:
+                watchers.discard(user_id)
+                continue
+            entry = view[message["space_id"]]
+            entry["last_message_id"] = message["id"]
+            entry["last_message_at"] = message["timestamp"]
+            if message["sender_id"] != user_id:
+                entry["unread_count"] += 1
+        if not watchers:
+            del self.watchers[message["space_id"]]
+
+    def on_message_deleted(self, space_id: int, message_id: int):
+        # Deleted messages count neither as unread nor as a space's latest.
+        # Whether this one was still unread for a user isn't known here, so
+        # views it may have counted in are dropped and rebuilt on next read.
+        watchers = self.watchers.get(space_id)
+        if not watchers:
+            return
+        for user_id in list(watchers):
+            view = self.views.peek(user_id)
+            entry = view.get(space_id) if view is not None else None
+            if entry is None:
+                watchers.discard(user_id)
+                continue
+            if entry["unread_count"] or entry["last_message_id"] == message_id:
+                self.views.pop(user_id)
+                watchers.discard(user_id)
+        if not watchers:
+            del self.watchers[space_id]
+
+    def on_read(self, user_id: int, space_id: int, message_id: int = None):
+        view = self.views.peek(user_id)
+        if view is None or space_id not in view:
+            return
+        entry = view[space_id]
+        if message_id is None or message_id == entry["last_message_id"]:
+            entry["unread_count"] = 0
+        else:
+            # Read up to an older message; let the next read recount
+            self.views.pop(user_id)
+
+my_spaces = SpaceListView()
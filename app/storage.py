@@ -0,0 +1,46 @@
+from sqlalchemy import event
+import os
+
+# SQLite storage profile. Every connection gets its pragmas as it is opened:
+# writers switch the database to WAL (which lets readers run alongside the one
+# writer), readers are marked query_only. The database module uses this to run
+# a single-connection writer pool next to a pool of reader connections.
+# Nothing here applies to other databases.
+
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+# NORMAL is durable across application crashes in WAL mode; FULL also across power loss
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "4"))
+
+
+def is_sqlite(url: str) -> bool:
+    return url.split(":", 1)[0].split("+", 1)[0] == "sqlite"
+
+def sqlite_pragmas(read_only: bool = False) -> list:
+    pragmas = [
+        f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}",
+        f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}",
+        f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}",
+        # Negative means KiB rather than pages
+        f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only = ON")
+    else:
+        # Stored in the database file, so readers pick it up too
+        pragmas.insert(0, f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+    return pragmas
+
+def apply_sqlite_profile(engine, read_only: bool = False):
+    # Pass the sync engine (async_engine.sync_engine for async)
+    pragmas = sqlite_pragmas(read_only)
+
+    @event.listens_for(engine, "connect")
+    def _configure(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
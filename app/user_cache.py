@@ -0,0 +1,55 @@
+from .utils.cache import TTLCache
+from . import metrics
+import os
+
+# Per-process caches behind auth.get_current_user. Verified tokens map to a
+# username (never past the token's own expiry) and usernames map to a compact
+# user record. Public profiles (what the public key endpoints return) are kept
+# separately. crud invalidates a user whenever their row changes; other workers
+# see the change once USER_CACHE_TTL / PUBLIC_KEY_CACHE_TTL runs out.
+
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+PUBLIC_KEY_CACHE_SIZE = int(os.getenv("PUBLIC_KEY_CACHE_SIZE", "50000"))
+PUBLIC_KEY_CACHE_TTL = float(os.getenv("PUBLIC_KEY_CACHE_TTL", "300"))
+
+
+class CachedUser:
+    __slots__ = ("id", "username", "display_name", "hashed_password", "public_key", "avatar")
+
+    def __init__(self, id: int, username: str, display_name: str, hashed_password: str, public_key: str, avatar: str = None):
+        self.id = id
+        self.username = username
+        self.display_name = display_name
+        self.hashed_password = hashed_password
+        self.public_key = public_key
+        self.avatar = avatar
+
+    @classmethod
+    def from_orm(cls, user) -> "CachedUser":
+        return cls(user.id, user.username, user.display_name, user.hashed_password, user.public_key, user.avatar)
+
+
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# username -> schemas.User-shaped dict
+public_key_cache = TTLCache(maxsize=PUBLIC_KEY_CACHE_SIZE, ttl=PUBLIC_KEY_CACHE_TTL)
+
+def public_profile(user) -> dict:
+    return {"username": user.username, "display_name": user.display_name, "public_key": user.public_key, "avatar": user.avatar, "id": user.id}
+
+def invalidate_user(username: str):
+    user_cache.pop(username)
+    public_key_cache.pop(username)
+
+def stats() -> dict:
+    return {"tokens": token_cache.stats(), "users": user_cache.stats(), "public_keys": public_key_cache.stats()}
+
+def _cache_counts(field: str):
+    return [((name,), cache_stats[field]) for name, cache_stats in stats().items()]
+
+metrics.CallbackGauge("auth_cache_hits_total", "Auth cache hits", lambda: _cache_counts("hits"), labelnames=("cache",), kind="counter")
+metrics.CallbackGauge("auth_cache_misses_total", "Auth cache misses", lambda: _cache_counts("misses"), labelnames=("cache",), kind="counter")
+metrics.CallbackGauge("auth_cache_size", "Auth cache entries", lambda: _cache_counts("size"), labelnames=("cache",))
@@ -0,0 +1,42 @@
+from collections import OrderedDict
+from typing import Hashable
+import time
+
+
+class TokenBuckets:
+    # Token buckets keyed by e.g. user or space id: `rate` tokens per second up
+    # to `burst`. Idle buckets are evicted LRU beyond `maxsize`; an evicted
+    # bucket comes back full, which is what an idle one would have been anyway.
+    # Single-threaded use only (the event loop), so no locking.
+    def __init__(self, rate: float, burst: float, maxsize: int):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        # key -> [tokens, last refill time]
+        self.buckets: "OrderedDict[Hashable, list]" = OrderedDict()
+
+    def _bucket(self, key: Hashable, now: float) -> list:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+            if len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def wait_time(self, key: Hashable, now: float = None) -> float:
+        # Seconds until a token is available for key (0 if one is now)
+        bucket = self._bucket(key, time.monotonic() if now is None else now)
+        if bucket[0] >= 1:
+            return 0.0
+        return (1 - bucket[0]) / self.rate
+
+    def take(self, key: Hashable):
+        # Only after wait_time() returned 0 for the same key and time
+        self.buckets[key][0] -= 1
+
+    def __len__(self) -> int:
+        return len(self.buckets)
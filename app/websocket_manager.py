@@ -1,23 +1,505 @@
-from typing import List, Dict
-from fastapi import WebSocket
+from collections import OrderedDict, deque
+from typing import Dict, Optional, Set, Union
+from fastapi import WebSocket, status
+from .backplane import Backplane, backplane_from_env
+from . import metrics, serializers
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+# What to do when a client's outbound queue is full:
+#   drop_oldest - discard the oldest queued frame to make room
+#   disconnect  - close the slow client; it can reconnect and catch up from history
+#   coalesce    - fold queued JSON data frames plus the new one into a single
+#                 {"type": "batch", "frames": [...]} frame; control frames,
+#                 raw relayed text and binary frames keep their own place in
+#                 the queue (if there is nothing to fold, drop the oldest)
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DISCONNECT = "disconnect"
+OVERFLOW_COALESCE = "coalesce"
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DISCONNECT, OVERFLOW_COALESCE)
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", OVERFLOW_DROP_OLDEST)
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+
+# Recent text frames kept per space so reconnecting clients can resume
+WS_REPLAY_BUFFER = int(os.getenv("WS_REPLAY_BUFFER", "256"))
+WS_REPLAY_SPACES = int(os.getenv("WS_REPLAY_SPACES", "1000"))
+
+# Binary (msgpack) frames at least this many bytes are deflated, once per
+# broadcast rather than once per socket; 0 disables. Text frames rely on the
+# server's permessage-deflate (uvicorn --ws-per-message-deflate).
+WS_COMPRESS_THRESHOLD = int(os.getenv("WS_COMPRESS_THRESHOLD", "512"))
+
+# Frames the server itself sends. Presence frames (see presence.py) go out
+# through publish_presence, skip the replay buffer and only reach sockets that
+# asked for presence. On plain /ws/{space_id} sockets relayed text reaches
+# peers as-is, so it must not be able to pass for any of these.
+SERVER_FRAME_TYPES = frozenset(("hello", "presence", "resync", "reconnect", "throttled", "error", "batch"))
+
+# On drain (see drain.py) every client is told to reconnect after a random
+# delay of up to WS_DRAIN_JITTER_MS, so they don't all arrive at once, and
+# queued frames get up to WS_DRAIN_TIMEOUT seconds to go out before the
+# sockets are closed with 1012 (service restart). WS_DRAIN_TIMEOUT=0 turns
+# draining off
+WS_DRAIN_TIMEOUT = float(os.getenv("WS_DRAIN_TIMEOUT", "10"))
+WS_DRAIN_JITTER_MS = int(os.getenv("WS_DRAIN_JITTER_MS", "5000"))
+
+Frame = Union[str, bytes]
+
+
+class ReplayBuffer:
+    # Ring of (seq, frame) for one space. Sequence numbers are per process,
+    # so they are only meaningful together with ConnectionManager.epoch.
+    def __init__(self, size: int):
+        self.frames = deque(maxlen=size)
+        self.last_seq = 0
+        # Nothing at or before this seq can be resumed from
+        self.floor = 0
+
+    def append(self, frame: str) -> int:
+        self.last_seq += 1
+        self.frames.append((self.last_seq, frame))
+        return self.last_seq
+
+    def since(self, last_seq: int):
+        # Frames after last_seq, or None when some of them were already evicted
+        if last_seq > self.last_seq or last_seq < self.floor:
+            return None
+        oldest = self.frames[0][0] if self.frames else self.last_seq + 1
+        if last_seq + 1 < oldest:
+            return None
+        return [(seq, frame) for seq, frame in self.frames if seq > last_seq]
+
+
+def is_server_frame(text: str) -> bool:
+    if not text.startswith("{") or '"type"' not in text:
+        return False
+    try:
+        frame = json.loads(text)
+    except ValueError:
+        return False
+    return isinstance(frame, dict) and frame.get("type") in SERVER_FRAME_TYPES
+
+def is_data_frame(frame: Frame) -> bool:
+    # JSON object frames carrying data (messages, envelopes): safe to batch
+    if not isinstance(frame, str) or not frame.startswith("{"):
+        return False
+    try:
+        value = json.loads(frame)
+    except ValueError:
+        return False
+    return isinstance(value, dict) and value.get("type") not in SERVER_FRAME_TYPES
+
+class BatchFrame(str):
+    # A coalesced batch, remembering its parts so it can absorb more frames
+    def __new__(cls, frames: list):
+        batch = super().__new__(cls, '{"type":"batch","frames":[' + ",".join(frames) + "]}")
+        batch.frames = frames
+        return batch
+
+def coalesce_frames(frames: list) -> list:
+    # Folds runs of data frames into batches, keeping everything else in order
+    result = []
+    run = None
+    for frame in frames:
+        if isinstance(frame, BatchFrame) or is_data_frame(frame):
+            if run is None:
+                run = []
+                result.append(run)
+            run.extend(frame.frames if isinstance(frame, BatchFrame) else (frame,))
+        else:
+            run = None
+            result.append(frame)
+    return [BatchFrame(item) if isinstance(item, list) else item for item in result]
+
+def sequenced_frame(seq: int, frame: str) -> str:
+    return json.dumps({"seq": seq, "data": frame})
+
+def multiplexed_frame(space_id: int, frame: str, seq: Optional[int] = None) -> str:
+    if seq is None:
+        return json.dumps({"space_id": space_id, "data": frame})
+    return json.dumps({"space_id": space_id, "seq": seq, "data": frame})
+
+
+class ConnectionWriter:
+    # Owns one socket's outbound queue and the task that drains it, so a slow
+    # client only ever delays itself.
+    def __init__(self, manager: "ConnectionManager", websocket: WebSocket, user_id: Optional[int] = None, sequenced: bool = False, multiplexed: bool = False, encoding: str = serializers.ENCODING_JSON, presence: bool = False, binary_content: bool = False):
+        self.manager = manager
+        self.websocket = websocket
+        self.user_id = user_id
+        # msgpack clients get binary data frames; control frames stay JSON text
+        self.binary = encoding == serializers.ENCODING_MSGPACK
+        # ...with message content as raw bytes, if the client asked for that
+        self.binary_content = self.binary and binary_content
+        # Sequenced clients get {"seq", "data"} envelopes and can resume;
+        # multiplexed ones (always sequenced) also get "space_id"
+        self.sequenced = sequenced or multiplexed
+        self.multiplexed = multiplexed
+        self.presence = presence or multiplexed
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=manager.queue_size)
+        self.spaces: Set[int] = set()
+        self.closed = False
+        # Live frames parked while catch-up rows are queued ahead of them
+        self.held: Optional[list] = None
+        self.task = asyncio.create_task(self._run())
+
+    def enqueue(self, frame: Frame, live: bool = True):
+        if self.closed:
+            return
+        if live and self.held is not None:
+            if len(self.held) >= self.manager.queue_size:
+                # Fell a whole queue behind before catch-up even finished
+                self.manager.drop(self.websocket, close_code=status.WS_1013_TRY_AGAIN_LATER)
+                return
+            self.held.append(frame)
+            return
+        try:
+            self.queue.put_nowait(frame)
+            return
+        except asyncio.QueueFull:
+            pass
+
+        policy = self.manager.overflow_policy
+        if policy == OVERFLOW_DISCONNECT:
+            self.manager.drop(self.websocket, close_code=status.WS_1013_TRY_AGAIN_LATER)
+        elif policy == OVERFLOW_COALESCE and self._coalesce(frame):
+            return
+        else:
+            self.queue.get_nowait()
+            # The dropped frame counts as done, so flushed() still returns
+            self.queue.task_done()
+            self.queue.put_nowait(frame)
+
+    def _coalesce(self, frame: Frame) -> bool:
+        coalesced = coalesce_frames(list(self.queue._queue) + [frame])
+        if len(coalesced) > self.queue.maxsize:
+            # Nothing to fold (e.g. a queue full of control frames)
+            return False
+        # Frames taken off the queue here are marked done so flushed() still returns
+        for _ in range(self.queue.qsize()):
+            self.queue.get_nowait()
+            self.queue.task_done()
+        for item in coalesced:
+            self.queue.put_nowait(item)
+        return True
+
+    def hold(self):
+        if self.held is None:
+            self.held = []
+
+    def release(self):
+        held, self.held = self.held, None
+        for frame in held or ():
+            self.enqueue(frame)
+
+    async def flushed(self):
+        # Everything queued so far has been sent (or the socket is gone)
+        if not self.closed:
+            await self.queue.join()
+
+    async def _run(self):
+        try:
+            while True:
+                frame = await self.queue.get()
+                if isinstance(frame, bytes):
+                    send = self.websocket.send_bytes(frame)
+                else:
+                    send = self.websocket.send_text(frame)
+                await asyncio.wait_for(send, timeout=self.manager.send_timeout)
+                self.queue.task_done()
+        except asyncio.CancelledError:
+            pass
+        except asyncio.TimeoutError:
+            # Stalled socket: close it so the client reconnects and catches up
+            self.manager.drop(self.websocket, close_code=status.WS_1013_TRY_AGAIN_LATER)
+        except Exception:
+            # Dead socket: unregister and close it instead of failing a broadcast
+            self.manager.drop(self.websocket, close_code=status.WS_1011_INTERNAL_ERROR)
+
+    def close(self, close_code: int = None):
+        if self.closed:
+            return
+        self.closed = True
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+        if close_code is not None:
+            asyncio.create_task(self._close_socket(close_code))
+
+    async def _close_socket(self, close_code: int):
+        try:
+            await self.websocket.close(code=close_code)
+        except Exception:
+            pass
+
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[int, List[WebSocket]] = {}
+    def __init__(self, queue_size: int = WS_SEND_QUEUE_SIZE, overflow_policy: str = WS_OVERFLOW_POLICY, send_timeout: float = WS_SEND_TIMEOUT, backplane: Backplane = None, replay_size: int = WS_REPLAY_BUFFER, replay_spaces: int = WS_REPLAY_SPACES, compress_threshold: int = WS_COMPRESS_THRESHOLD, drain_timeout: float = WS_DRAIN_TIMEOUT, drain_jitter_ms: int = WS_DRAIN_JITTER_MS):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.send_timeout = send_timeout
+        self.compress_threshold = compress_threshold
+        self.drain_timeout = drain_timeout
+        self.drain_jitter_ms = drain_jitter_ms
+        self.backplane = backplane or backplane_from_env()
+        self.active_connections: Dict[int, Set[WebSocket]] = {}
+        self.writers: Dict[WebSocket, ConnectionWriter] = {}
+        self.by_user: Dict[int, Set[WebSocket]] = {}
+        self.replay_size = replay_size
+        self.replay_spaces = replay_spaces
+        self.replay: "OrderedDict[int, ReplayBuffer]" = OrderedDict()
+        # Changes on every restart; resuming across epochs falls back to the DB
+        self.epoch = uuid.uuid4().hex
+        # PresenceService registers itself here to hear about joins and leaves
+        self.presence = None
+        # Set by drain(); endpoints turn new sockets away from then on
+        self.draining = False
+
+    async def start(self):
+        await self.backplane.start(self.deliver)
+
+    async def stop(self):
+        await self.backplane.stop()
+
+    async def drain(self):
+        # Ask every client to reconnect elsewhere (or here, after a restart),
+        # give their queued frames until timeout to go out, then close them all
+        self.draining = True
+        writers = [writer for writer in self.writers.values() if not writer.closed]
+        if not writers:
+            return
+        for writer in writers:
+            writer.enqueue(json.dumps({"type": "reconnect", "epoch": self.epoch, "delay_ms": random.randint(0, self.drain_jitter_ms)}))
+        flushes = [asyncio.create_task(writer.flushed()) for writer in writers]
+        _, pending = await asyncio.wait(flushes, timeout=self.drain_timeout)
+        for task in pending:
+            task.cancel()
+        for writer in writers:
+            self.drop(writer.websocket)
+        await asyncio.gather(*(writer._close_socket(status.WS_1012_SERVICE_RESTART) for writer in writers))
 
-    async def connect(self, websocket: WebSocket, space_id: int):
+    def _remove_from_space(self, websocket: WebSocket, space_id: int):
+        connections = self.active_connections.get(space_id)
+        if connections is None:
+            return
+        if websocket not in connections:
+            return
+        connections.remove(websocket)
+        writer = self.writers.get(websocket)
+        if self.presence is not None and writer is not None and writer.user_id is not None:
+            self.presence.left(space_id, writer.user_id)
+        if not connections:
+            # Last local socket for this space: stop receiving its traffic
+            del self.active_connections[space_id]
+            self.backplane.unsubscribe(space_id)
+
+    def _replay_buffer(self, space_id: int) -> ReplayBuffer:
+        buffer = self.replay.get(space_id)
+        if buffer is None:
+            buffer = self.replay[space_id] = ReplayBuffer(self.replay_size)
+            while len(self.replay) > self.replay_spaces:
+                self.replay.popitem(last=False)
+        else:
+            self.replay.move_to_end(space_id)
+        return buffer
+
+    async def accept(self, websocket: WebSocket, user_id: Optional[int] = None, sequenced: bool = False, multiplexed: bool = False, encoding: str = serializers.ENCODING_JSON, presence: bool = False, binary_content: bool = False) -> ConnectionWriter:
         await websocket.accept()
+        writer = ConnectionWriter(self, websocket, user_id=user_id, sequenced=sequenced, multiplexed=multiplexed, encoding=encoding, presence=presence, binary_content=binary_content)
+        self.writers[websocket] = writer
+        if user_id is not None:
+            self.by_user.setdefault(user_id, set()).add(websocket)
+        return writer
+
+    def subscribe(self, websocket: WebSocket, space_id: int, last_seq: Optional[int] = None, epoch: Optional[str] = None) -> bool:
+        # Add an accepted socket to a space. Returns False when the frames
+        # after last_seq can't be replayed from memory and the caller must
+        # catch up from the DB.
+        writer = self.writers.get(websocket)
+        if writer is None:
+            return True
+        if space_id not in self.active_connections and self.backplane.cross_process and space_id in self.replay:
+            # We weren't subscribed a moment ago, so frames may be missing
+            self.replay[space_id].floor = self.replay[space_id].last_seq
+
+        resumed = True
+        if writer.sequenced:
+            buffer = self._replay_buffer(space_id)
+            hello = {"type": "hello", "space_id": space_id, "epoch": self.epoch, "seq": buffer.last_seq}
+            if writer.binary:
+                hello.update(encoding=serializers.ENCODING_MSGPACK, fields=serializers.MESSAGE_ROW_FIELDS,
+                             content="binary" if writer.binary_content else "text")
+            writer.enqueue(json.dumps(hello))
+            if last_seq:
+                missed = buffer.since(last_seq) if epoch == self.epoch else None
+                if missed is None:
+                    resumed = False
+                else:
+                    for seq, frame in missed:
+                        writer.enqueue(self._frame_for(writer, space_id, seq, frame))
+
+        # No await between replay and registration, so nothing falls in between
+        writer.spaces.add(space_id)
         if space_id not in self.active_connections:
-            self.active_connections[space_id] = []
-        self.active_connections[space_id].append(websocket)
+            self.active_connections[space_id] = set()
+            self.backplane.subscribe(space_id)
+        connections = self.active_connections[space_id]
+        if websocket not in connections:
+            connections.add(websocket)
+            if self.presence is not None and writer.user_id is not None:
+                self.presence.joined(space_id, writer.user_id)
+        if writer.presence and self.presence is not None:
+            writer.enqueue(self.presence.snapshot(space_id))
+        return resumed
+
+    def unsubscribe(self, websocket: WebSocket, space_id: int):
+        self._remove_from_space(websocket, space_id)
+        writer = self.writers.get(websocket)
+        if writer is not None:
+            writer.spaces.discard(space_id)
+
+    def _frame_for(self, writer: ConnectionWriter, space_id: int, seq: Optional[int], frame: str) -> Frame:
+        if writer.binary:
+            return serializers.binary_frame(space_id, seq, frame, self.compress_threshold, writer.binary_content)
+        if writer.multiplexed:
+            return multiplexed_frame(space_id, frame, seq)
+        if writer.sequenced and seq is not None:
+            return sequenced_frame(seq, frame)
+        return frame
+
+    async def connect(self, websocket: WebSocket, space_id: int, last_seq: Optional[int] = None, epoch: Optional[str] = None, user_id: Optional[int] = None, encoding: str = serializers.ENCODING_JSON, presence: bool = False, binary_content: bool = False) -> bool:
+        # Single-space socket; passing last_seq (0 for a first connect) opts it
+        # into sequenced frames
+        await self.accept(websocket, user_id=user_id, sequenced=last_seq is not None, encoding=encoding, presence=presence, binary_content=binary_content)
+        return self.subscribe(websocket, space_id, last_seq=last_seq, epoch=epoch)
+
+    def send(self, websocket: WebSocket, frame: Frame, space_id: Optional[int] = None):
+        # Queue a frame for one socket, behind anything already queued but
+        # ahead of live frames held back during catch-up
+        writer = self.writers.get(websocket)
+        if writer is not None:
+            # space_id marks a data frame, which is wrapped like a broadcast
+            if space_id is not None and isinstance(frame, str):
+                frame = self._frame_for(writer, space_id, None, frame)
+            writer.enqueue(frame, live=False)
+
+    def hold_live(self, websocket: WebSocket):
+        # Until release_live, broadcasts for this socket wait behind whatever
+        # is sent to it directly, so missed history arrives before newer frames
+        writer = self.writers.get(websocket)
+        if writer is not None:
+            writer.hold()
+
+    def release_live(self, websocket: WebSocket):
+        writer = self.writers.get(websocket)
+        if writer is not None:
+            writer.release()
+
+    def user_sockets(self, user_id: int) -> Set[WebSocket]:
+        return self.by_user.get(user_id, set())
+
+    def _release(self, writer: ConnectionWriter, close_code: int = None):
+        del self.writers[writer.websocket]
+        if writer.user_id is not None:
+            sockets = self.by_user.get(writer.user_id)
+            if sockets is not None:
+                sockets.discard(writer.websocket)
+                if not sockets:
+                    del self.by_user[writer.user_id]
+        writer.close(close_code)
 
     def disconnect(self, websocket: WebSocket, space_id: int):
-        if space_id in self.active_connections:
-            self.active_connections[space_id].remove(websocket)
+        # Single-space sockets: leaving the last space releases the socket
+        self.unsubscribe(websocket, space_id)
+        writer = self.writers.get(websocket)
+        if writer is not None and not writer.spaces:
+            self._release(writer)
 
-    async def broadcast(self, message: str, space_id: int):
-        if space_id in self.active_connections:
-            for connection in self.active_connections[space_id]:
-                await connection.send_text(message)
+    def drop(self, websocket: WebSocket, close_code: int = None):
+        # Remove a socket from every space, e.g. on close or after a failed send
+        writer = self.writers.get(websocket)
+        if writer is None:
+            return
+        for space_id in writer.spaces:
+            self._remove_from_space(websocket, space_id)
+        writer.spaces.clear()
+        self._release(writer, close_code)
+
+    async def broadcast(self, message: Frame, space_id: int):
+        self.deliver_and_publish(space_id, message)
+
+    def deliver_and_publish(self, space_id: int, message: Frame):
+        # Serve local sockets right away, then hand the frame to the backplane
+        # for sockets held by other workers.
+        self.deliver(space_id, message)
+        self.backplane.publish(space_id, message)
+
+    def publish_presence(self, space_id: int, frame: str):
+        self._deliver_presence(space_id, frame)
+        self.backplane.publish(space_id, frame, presence=True)
+
+    def deliver(self, space_id: int, message: Frame, presence: bool = False):
+        # The payload is encoded once by the caller and the same frame object is
+        # queued for every member; each envelope variant (sequenced, multiplexed,
+        # binary) is also built at most once. Delivery happens on the writers.
+        if presence:
+            self._deliver_presence(space_id, message)
+            return
+        seq = None
+        if isinstance(message, str):
+            seq = self._replay_buffer(space_id).append(message)
+        connections = self.active_connections.get(space_id)
+        if not connections:
+            return
+        start = time.perf_counter()
+        envelope = None
+        mux_envelope = None
+        # binary_content -> frame
+        binary = {}
+        for websocket in list(connections):
+            writer = self.writers.get(websocket)
+            if writer is None:
+                continue
+            if writer.binary and seq is not None:
+                frame = binary.get(writer.binary_content)
+                if frame is None:
+                    frame = binary[writer.binary_content] = serializers.binary_frame(space_id, seq, message, self.compress_threshold, writer.binary_content)
+                writer.enqueue(frame)
+            elif seq is None or not writer.sequenced:
+                writer.enqueue(message)
+            elif writer.multiplexed:
+                if mux_envelope is None:
+                    mux_envelope = multiplexed_frame(space_id, message, seq)
+                writer.enqueue(mux_envelope)
+            else:
+                if envelope is None:
+                    envelope = sequenced_frame(seq, message)
+                writer.enqueue(envelope)
+        metrics.broadcast_duration.observe(time.perf_counter() - start)
+        metrics.broadcast_fanout_size.observe(len(connections))
+
+    def _deliver_presence(self, space_id: int, message: str):
+        for websocket in list(self.active_connections.get(space_id, ())):
+            writer = self.writers.get(websocket)
+            if writer is not None and writer.presence:
+                writer.enqueue(message)
 
 manager = ConnectionManager()
+
+metrics.CallbackGauge(
+    "ws_connections", "Open WebSocket connections per space",
+    lambda: (((str(space_id),), len(connections)) for space_id, connections in list(manager.active_connections.items())),
+    labelnames=("space_id",))
+metrics.CallbackGauge(
+    "ws_users", "Users with at least one open WebSocket",
+    lambda: [((), len(manager.by_user))])
+metrics.CallbackGauge(
+    "ws_send_queue_depth", "Frames queued across all WebSocket writers",
+    lambda: [((), sum(writer.queue.qsize() for writer in list(manager.writers.values())))])
@@ -0,0 +1,292 @@
+"""Load/benchmark harness for the REST and WebSocket hot paths.
+
+Starts ``uvicorn app.main:app`` in a subprocess against a throwaway SQLite file,
+simulates USERS users spread over SPACES spaces and reports, per scenario,
+throughput, p50/p95/p99 latency and the server's resident memory as JSON.
+
+    python -m benchmarks.bench --users 200 --spaces 10 --out bench.json
+    python -m benchmarks.bench --save-baseline benchmarks/baseline.json
+    python -m benchmarks.bench --baseline benchmarks/baseline.json --max-regression 0.2
+
+With --baseline the run is compared scenario by scenario and the exit code is 1
+when any p95 latency regresses by more than --max-regression.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+class Recorder:
+    def __init__(self, server_pid):
+        self.server_pid = server_pid
+        self.results = {}
+
+    async def run(self, name, calls, concurrency):
+        # calls: list of zero-arg coroutine factories, each one timed request
+        latencies = []
+        errors = 0
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def timed(call):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await call()
+                except Exception:
+                    errors += 1
+                    return
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(timed(call) for call in calls))
+        self.record(name, latencies, time.perf_counter() - start, errors)
+
+    def record(self, name, latencies_ms, elapsed, errors=0):
+        self.results[name] = {
+            "count": len(latencies_ms),
+            "errors": errors,
+            "throughput_per_s": round(len(latencies_ms) / elapsed, 1) if elapsed else None,
+            "p50_ms": _round(percentile(latencies_ms, 50)),
+            "p95_ms": _round(percentile(latencies_ms, 95)),
+            "p99_ms": _round(percentile(latencies_ms, 99)),
+            "server_rss_mb": rss_mb(self.server_pid),
+        }
+        print(f"{name:<16} {json.dumps(self.results[name])}", file=sys.stderr)
+
+
+def _round(value):
+    return None if value is None else round(value, 2)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workdir, port, extra_env):
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        "SECRET_KEY": "benchmark-secret",
+        "ALGORITHM": "HS256",
+        "ACCESS_TOKEN_EXPIRE_MINUTES": "60",
+        "BCRYPT_ROUNDS": "4",
+        # The post phase sends far faster than any one user is allowed to;
+        # measure the pipeline, not the ingress limiter (--env turns it back
+        # on, and then 429s are counted as post_message errors)
+        "RATE_LIMIT_USER_RATE": "0",
+        "RATE_LIMIT_SPACE_RATE": "0",
+    })
+    env.update(extra_env)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+async def wait_until_ready(client, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await client.get("/docs")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+async def run_scenarios(args, base_url, recorder):
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        await wait_until_ready(client)
+        usernames = [f"bench{i}" for i in range(args.users)]
+        tokens = {}
+
+        async def register(username):
+            response = await client.post("/users/register", json={
+                "username": username, "display_name": username.upper(), "public_key": "pk", "password": "benchmark"
+            })
+            response.raise_for_status()
+
+        async def login(username):
+            response = await client.post("/users/token", data={"username": username, "password": "benchmark"})
+            response.raise_for_status()
+            tokens[username] = response.json()["access_token"]
+
+        await recorder.run("register", [lambda u=u: register(u) for u in usernames], args.concurrency)
+        await recorder.run("login", [lambda u=u: login(u) for u in usernames], args.concurrency)
+
+        def headers(username):
+            return {"Authorization": f"Bearer {tokens[username]}"}
+
+        # Each space is created by one user and every user joins one space
+        owners = usernames[:args.spaces]
+        space_ids = []
+        for owner in owners:
+            response = await client.post("/spaces/", params={"encrypted_space_key": "k"}, json={"name": f"space-{owner}"}, headers=headers(owner))
+            response.raise_for_status()
+            space_ids.append(response.json()["id"])
+        members = {space_id: [owner] for space_id, owner in zip(space_ids, owners)}
+        for index, username in enumerate(usernames[args.spaces:]):
+            space_id = space_ids[index % len(space_ids)]
+            owner = owners[index % len(owners)]
+            response = await client.post(f"/spaces/{space_id}/add_member", json={"username": username, "encrypted_space_key": "k"}, headers=headers(owner))
+            response.raise_for_status()
+            members[space_id].append(username)
+
+        await recorder.run("spaces_me", [lambda u=u: _get(client, "/spaces/me", headers(u)) for u in usernames], args.concurrency)
+
+        # Fan-out: every member holds a socket; time POST latency and full delivery
+        ws_base = base_url.replace("http", "ws", 1)
+        sockets = {}
+        for space_id, space_members in members.items():
+            sockets[space_id] = [
+                await websockets.connect(f"{ws_base}/ws/{space_id}?token={tokens[username]}", max_queue=None)
+                for username in space_members
+            ]
+        post_latencies, delivery_latencies, message_ids = [], [], []
+        throttled = 0
+        start = time.perf_counter()
+        for round_index in range(args.messages):
+            space_id = space_ids[round_index % len(space_ids)]
+            sender = members[space_id][round_index % len(members[space_id])]
+            sent_at = time.perf_counter()
+            response = await client.post("/messages/", params={"space_id": space_id}, json={"content": f"ciphertext-{round_index}"}, headers=headers(sender))
+            if response.status_code == 429:
+                # Only when run with the rate limiter on; nothing to deliver
+                throttled += 1
+                continue
+            response.raise_for_status()
+            post_latencies.append((time.perf_counter() - sent_at) * 1000)
+            message_ids.append((sender, response.json()["id"]))
+            await asyncio.gather(*(ws.recv() for ws in sockets[space_id]))
+            delivery_latencies.append((time.perf_counter() - sent_at) * 1000)
+        elapsed = time.perf_counter() - start
+        recorder.record("post_message", post_latencies, elapsed, throttled)
+        recorder.record("fanout_delivery", delivery_latencies, elapsed)
+        for space_sockets in sockets.values():
+            for ws in space_sockets:
+                await ws.close()
+
+        history_calls = []
+        for space_id in space_ids:
+            for username in members[space_id][:args.history_readers]:
+                history_calls.append(lambda s=space_id, u=username: _get(client, f"/messages/{s}", headers(u)))
+        await recorder.run("history", history_calls, args.concurrency)
+
+        await recorder.run("delete_message", [
+            lambda u=u, m=m: _delete(client, f"/messages/{m}", headers(u)) for u, m in message_ids
+        ], args.concurrency)
+
+
+async def _get(client, path, headers):
+    response = await client.get(path, headers=headers)
+    response.raise_for_status()
+
+
+async def _delete(client, path, headers):
+    response = await client.delete(path, headers=headers)
+    response.raise_for_status()
+
+
+def compare(results, baseline, max_regression):
+    regressions = []
+    comparison = {}
+    for name, current in results.items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous or not previous.get("p95_ms") or current.get("p95_ms") is None:
+            continue
+        change = (current["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"]
+        comparison[name] = {"baseline_p95_ms": previous["p95_ms"], "p95_ms": current["p95_ms"], "p95_change": round(change, 3)}
+        if change > max_regression:
+            regressions.append(name)
+    return comparison, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--spaces", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--history-readers", type=int, default=10, help="members per space that fetch history")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra server environment")
+    parser.add_argument("--out", help="write results JSON here (default: stdout)")
+    parser.add_argument("--baseline", help="compare against a saved results file")
+    parser.add_argument("--save-baseline", help="also save the results as a baseline file")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed relative p95 increase")
+    args = parser.parse_args()
+    if args.spaces > args.users:
+        parser.error("--spaces cannot exceed --users")
+
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        server = start_server(workdir, port, extra_env)
+        recorder = Recorder(server.pid)
+        try:
+            asyncio.run(run_scenarios(args, f"http://127.0.0.1:{port}", recorder))
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    output = {
+        "config": {key: getattr(args, key) for key in ("users", "spaces", "messages", "history_readers", "concurrency")},
+        "scenarios": recorder.results,
+    }
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            comparison, regressions = compare(recorder.results, json.load(baseline_file), args.max_regression)
+        output["comparison"] = comparison
+        output["regressions"] = regressions
+        exit_code = 1 if regressions else 0
+
+    text = json.dumps(output, indent=2)
+    if args.out:
+        with open(args.out, "w") as out_file:
+            out_file.write(text)
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            baseline_file.write(text)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Per-row cost of the list-route serializers versus Pydantic models.
+
+Encodes the same synthetic rows through the old path (validate against the
+response_model, dump to JSON-able Python, then JSONResponse.render, as FastAPI
+does for a list response) and through app.serializers, and reports
+microseconds per row for each list schema.
+
+    python -m benchmarks.serialization --rows 200 --repeat 200
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+from app import schemas, serializers
+
+
+def message_rows(count):
+    now = datetime.datetime(2024, 1, 1, 12, 0, 0, 123456)
+    return [
+        (index, 1, index % 7, "Y2lwaGVydGV4dC1" * 6 + str(index), now + datetime.timedelta(seconds=index), 0, f"User {index % 7}")
+        for index in range(count)
+    ]
+
+
+def user_rows(count):
+    return [(f"user{index}", f"User {index}", "-----BEGIN PUBLIC KEY-----" + "A" * 300, None, index) for index in range(count)]
+
+
+def space_entries(count):
+    now = datetime.datetime(2024, 1, 1, 12, 0, 0)
+    return [
+        {"id": index, "name": f"space {index}", "created_by": 1, "encrypted_space_key": "k" * 120, "creator_display_name": "Owner",
+         "last_message_id": index * 10, "last_message_at": now, "unread_count": index % 5}
+        for index in range(count)
+    ]
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    cases = {
+        "messages": (
+            message_rows(args.rows), schemas.Message,
+            lambda row: dict(zip(serializers.MESSAGE_ROW_FIELDS, row)), serializers.message_serializer.dumps,
+        ),
+        "members": (
+            user_rows(args.rows), schemas.User,
+            lambda row: dict(zip(serializers.USER_FIELDS, row)), serializers.user_serializer.dumps,
+        ),
+        "spaces_me": (
+            space_entries(args.rows), schemas.SpaceSummary,
+            lambda entry: entry, serializers.space_summary_serializer.dumps_mappings,
+        ),
+    }
+    results = {}
+    for name, (rows, model, as_dict, fast) in cases.items():
+        adapter = TypeAdapter(list[model])
+
+        def pydantic_path():
+            validated = adapter.validate_python([as_dict(row) for row in rows])
+            return JSONResponse(adapter.dump_python(validated, mode="json")).body
+
+        # Same response body either way
+        assert json.loads(pydantic_path()) == json.loads(fast(rows)), name
+        before = timed(pydantic_path, args.repeat) / len(rows) * 1e6
+        after = timed(lambda: fast(rows), args.repeat) / len(rows) * 1e6
+        results[name] = {"pydantic_us_per_row": round(before, 2), "serializer_us_per_row": round(after, 2), "speedup": round(before / after, 1)}
+    print(json.dumps({"rows": args.rows, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# The app reads its configuration at import time, so point it at a throwaway
+# database before anything imports it
+_db_dir = tempfile.mkdtemp(prefix="chat-app-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
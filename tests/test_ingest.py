@@ -0,0 +1,160 @@
+import asyncio
+
+import pytest
+from sqlalchemy import delete, select
+from sqlalchemy.exc import OperationalError, TimeoutError
+
+from app import database, ingest, models
+
+
+@pytest.fixture(autouse=True)
+def schema(monkeypatch):
+    database.ensure_schema(models.Base.metadata)
+    with database.engine.begin() as conn:
+        conn.execute(delete(models.Message))
+        conn.execute(delete(models.IdSequence))
+    monkeypatch.setattr(ingest, "INGEST_RETRY_DELAY", 0.001)
+    yield
+
+
+def run(coro):
+    async def wrapper():
+        try:
+            return await coro
+        finally:
+            await database.async_engine.dispose()
+    return asyncio.run(wrapper())
+
+
+async def stored_ids():
+    async with database.AsyncSessionLocal() as db:
+        return (await db.execute(select(models.Message.id).order_by(models.Message.id))).scalars().all()
+
+
+def database_locked():
+    return OperationalError("INSERT INTO messages", {}, Exception("database is locked"))
+
+
+class FlakyEngine:
+    # Fails the first `failures` transactions, by default the way a locked
+    # database does
+    def __init__(self, engine, failures, error=database_locked):
+        self.engine = engine
+        self.failures = failures
+        self.error = error
+
+    def begin(self):
+        if self.failures:
+            self.failures -= 1
+            raise self.error()
+        return self.engine.begin()
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+
+def test_batches_land_with_consecutive_ids():
+    async def scenario():
+        ingestor = ingest.MessageIngestor(batch_size=4, id_block_size=10)
+        await ingestor.start()
+        rows = [await ingestor.submit(space_id=1, sender_id=1, content=f"m{i}") for i in range(10)]
+        assert ingestor.has_pending(1)
+        await ingestor.flush()
+        assert not ingestor.has_pending(1)
+        await ingestor.stop()
+        return [row["id"] for row in rows], await stored_ids()
+
+    ids, stored = run(scenario())
+    assert ids == list(range(ids[0], ids[0] + 10))
+    assert stored == ids
+
+
+def test_id_blocks_do_not_overlap_between_ingestors():
+    async def scenario():
+        first = ingest.MessageIngestor(id_block_size=3)
+        second = ingest.MessageIngestor(id_block_size=3)
+        await first.start()
+        await second.start()
+        ids = []
+        for _ in range(5):
+            ids.append((await first.submit(space_id=1, sender_id=1, content="a"))["id"])
+            ids.append((await second.submit(space_id=1, sender_id=1, content="b"))["id"])
+        await first.stop()
+        await second.stop()
+        return ids, await stored_ids()
+
+    ids, stored = run(scenario())
+    assert len(set(ids)) == len(ids)
+    assert stored == sorted(ids)
+
+
+def test_transient_errors_are_retried_until_the_batch_lands(monkeypatch):
+    monkeypatch.setattr(ingest.database, "async_engine", FlakyEngine(database.async_engine, failures=0))
+
+    async def scenario():
+        ingestor = ingest.MessageIngestor(id_block_size=10)
+        await ingestor.start()
+        rows = [await ingestor.submit(space_id=1, sender_id=1, content=f"m{i}") for i in range(3)]
+        # The id block is reserved; now every write fails a few times
+        ingest.database.async_engine.failures = 5
+        await ingestor.flush()
+        await ingestor.stop()
+        return [row["id"] for row in rows], await stored_ids()
+
+    ids, stored = run(scenario())
+    assert stored == ids
+
+
+def test_writer_task_survives_pool_timeouts(monkeypatch):
+    # Not a DBAPIError: the one-connection write pool timing out on begin()
+    engine = FlakyEngine(database.async_engine, failures=2, error=lambda: TimeoutError("QueuePool limit reached"))
+    monkeypatch.setattr(ingest.database, "async_engine", engine)
+
+    async def scenario():
+        ingestor = ingest.MessageIngestor(id_block_size=10, flush_interval_ms=1)
+        await ingestor.start()
+        first = await ingestor.submit(space_id=1, sender_id=1, content="first")
+        engine.failures = 2
+        while ingestor.has_pending(1):
+            await asyncio.sleep(0.01)
+        assert not ingestor.task.done()
+        second = await ingestor.submit(space_id=1, sender_id=1, content="second")
+        await ingestor.stop()
+        return [first["id"], second["id"]], await stored_ids()
+
+    ids, stored = run(scenario())
+    assert stored == ids
+
+
+def test_submit_refuses_once_the_writer_is_gone():
+    async def scenario():
+        ingestor = ingest.MessageIngestor()
+        await ingestor.start()
+        await ingestor.stop()
+        ingestor.task = asyncio.create_task(asyncio.sleep(0))
+        await ingestor.task
+        with pytest.raises(RuntimeError):
+            await ingestor.submit(space_id=1, sender_id=1, content="lost")
+
+    run(scenario())
+
+
+def test_only_rows_violating_constraints_are_dropped():
+    async def scenario():
+        ingestor = ingest.MessageIngestor(id_block_size=10)
+        await ingestor.start()
+        kept = await ingestor.submit(space_id=1, sender_id=1, content="kept")
+        await ingestor.flush()
+        # A duplicate id can't be inserted; the rest of its batch still is
+        duplicate = dict(kept, content="duplicate")
+        fresh = await ingestor.submit(space_id=1, sender_id=1, content="fresh")
+        await ingestor._insert_rows([duplicate, fresh])
+        await ingestor.stop()
+        return kept["id"], fresh["id"], await stored_ids()
+
+    kept_id, fresh_id, stored = run(scenario())
+    assert stored == [kept_id, fresh_id]
+
+
+def test_flush_before_start_is_a_no_op():
+    run(ingest.MessageIngestor().flush())
@@ -0,0 +1,50 @@
+import asyncio
+
+from app import membership
+
+
+class CountingSession:
+    # Stands in for a session whose member point query always comes back empty
+    def __init__(self):
+        self.queries = 0
+
+    async def execute(self, statement):
+        self.queries += 1
+        return EmptyResult()
+
+
+class EmptyResult:
+    def scalars(self):
+        return iter(())
+
+    def first(self):
+        return None
+
+
+def test_refusals_are_cached_until_added():
+    index = membership.MembershipIndex(negative_ttl=60)
+    db = CountingSession()
+
+    async def check():
+        return await index.is_member(db, 1, 2)
+
+    assert asyncio.run(check()) is False
+    queries = db.queries
+    assert asyncio.run(check()) is False
+    assert db.queries == queries
+
+    index.add(1, 2)
+    assert asyncio.run(check()) is True
+
+
+def test_refusals_expire():
+    index = membership.MembershipIndex(negative_ttl=0)
+    db = CountingSession()
+
+    async def check():
+        return await index.is_member(db, 1, 2)
+
+    asyncio.run(check())
+    queries = db.queries
+    asyncio.run(check())
+    assert db.queries > queries
@@ -0,0 +1,42 @@
+import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import archive
+from app.main import app
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    message_archive = archive.MessageArchive(directory=str(tmp_path), after_days=0)
+    message_archive.enabled = True
+    monkeypatch.setattr(archive, "message_archive", message_archive)
+    with TestClient(app) as client:
+        yield client
+
+
+def register(client, username):
+    response = client.post("/users/register", json={"username": username, "display_name": username, "public_key": "pk", "password": "pw"})
+    assert response.status_code == 200, response.text
+    token = client.post("/users/token", data={"username": username, "password": "pw"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_deleting_an_archived_message_is_gone(client):
+    suffix = datetime.datetime.utcnow().strftime("%H%M%S%f")
+    owner = register(client, f"owner{suffix}")
+    other = register(client, f"other{suffix}")
+    space_id = client.post("/spaces/?encrypted_space_key=k", json={"name": "s"}, headers=owner).json()["id"]
+    client.post(f"/spaces/{space_id}/add_member", json={"username": f"other{suffix}", "encrypted_space_key": "k"}, headers=owner)
+    message_id = client.post(f"/messages/?space_id={space_id}", json={"content": "old"}, headers=owner).json()["id"]
+    client.get(f"/messages/{space_id}", headers=owner)  # lands the write-behind queue
+
+    archive.message_archive.after_days = 1e-9
+    assert client.portal.call(archive.message_archive.archive_old_messages) >= 1
+
+    assert client.delete(f"/messages/{message_id}", headers=other).status_code == 403
+    response = client.delete(f"/messages/{message_id}", headers=owner)
+    assert response.status_code == 410
+    assert "archived" in response.json()["detail"]
+    assert client.delete(f"/messages/{message_id + 1000}", headers=owner).status_code == 404
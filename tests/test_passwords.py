@@ -0,0 +1,18 @@
+import asyncio
+
+from app import passwords
+
+
+def test_pool_survives_restart():
+    pool = passwords.PasswordPool(workers=1)
+
+    async def cycle():
+        await pool.start()
+        hashed = await pool.hash("secret")
+        assert await pool.verify("secret", hashed)
+        await pool.stop()
+
+    asyncio.run(cycle())
+    # A stopped pool can be started again in the same process
+    asyncio.run(cycle())
+    assert pool.executor is None
@@ -0,0 +1,24 @@
+import json
+
+import msgpack
+
+from app import serializers
+
+
+def unpack(frame: bytes):
+    assert frame[:1] == serializers.BINARY_PLAIN
+    return msgpack.unpackb(frame[1:])
+
+
+def message_frame(content: str) -> str:
+    return json.dumps(dict(zip(serializers.MESSAGE_ROW_FIELDS, (1, 2, 3, content, "2024-01-01T00:00:00", 0, "A"))))
+
+
+def test_content_stays_text_unless_marked_binary():
+    frame = message_frame("ping")
+    assert unpack(serializers.binary_frame(2, 1, frame))[2][3] == "ping"
+    assert unpack(serializers.binary_frame(2, 1, frame, binary_content=True))[2][3] == b"\xa6)\xe0"
+
+
+def test_raw_frames_are_never_decoded():
+    assert unpack(serializers.binary_frame(2, 1, "ping", binary_content=True))[2] == "ping"
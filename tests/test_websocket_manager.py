@@ -0,0 +1,42 @@
+import asyncio
+import json
+
+from app import websocket_manager
+
+
+class StalledSocket:
+    # A client that never reads: the first send blocks forever
+    async def send_text(self, frame):
+        await asyncio.Event().wait()
+
+    async def send_bytes(self, frame):
+        await asyncio.Event().wait()
+
+
+def test_coalesce_batches_only_data_frames():
+    async def scenario():
+        manager = websocket_manager.ConnectionManager(queue_size=4, overflow_policy=websocket_manager.OVERFLOW_COALESCE, send_timeout=60)
+        writer = websocket_manager.ConnectionWriter(manager, StalledSocket())
+        writer.enqueue("in flight")
+        await asyncio.sleep(0)
+        frames = ['{"id": 1}', '{"type": "resync", "space_id": 1}', '{"id": 2}', "raw ciphertext", '{"id": 3}', '{"id": 4}']
+        for frame in frames:
+            writer.enqueue(frame)
+        queued = list(writer.queue._queue)
+        writer.task.cancel()
+        return queued
+
+    queued = asyncio.run(scenario())
+    # {"id": 3} found nothing to fold into fewer than four frames, so the
+    # oldest frame made room; {"id": 4} then joined it in a batch
+    assert [json.loads(frame) if frame.startswith("{") else frame for frame in queued] == [
+        {"type": "resync", "space_id": 1},
+        {"type": "batch", "frames": [{"id": 2}]},
+        "raw ciphertext",
+        {"type": "batch", "frames": [{"id": 3}, {"id": 4}]},
+    ]
+
+
+def test_coalesced_batches_absorb_later_frames():
+    batch = websocket_manager.coalesce_frames(['{"id": 1}', '{"id": 2}'])
+    assert websocket_manager.coalesce_frames(batch + ['{"id": 3}']) == ['{"type":"batch","frames":[{"id": 1},{"id": 2},{"id": 3}]}']